@@ -0,0 +1,457 @@
+import csv
+import math
+import os
+import tempfile
+import warnings
+
+import fiona
+import geopandas as gpd
+import pandas as pd
+
+import helpers
+
+######################################################################
+#
+# Out-of-core loading and aggregation for large units
+# (e.g., census blocks of several states)
+#
+# `helpers.build_district_plan` loads every unit into pandas and
+# networkx objects at once, which is fine for ~1,400 tracts but not
+# for hundreds of thousands of blocks. Here
+#   - shapefiles and CSV attributes are streamed in row groups,
+#   - adjacency (with shared-boundary lengths) is built tile by tile,
+#     after one pass spills the units to per-tile files on disk,
+#     and written to a CSV file, and
+#   - district tallies are accumulated incrementally after the
+#     attribute and assignment CSVs are hash-partitioned by GEOID.
+# Row group sizes, tile sizes, and the number of partitions are all
+# derived from the memory limit in a ChunkConfig.
+#
+######################################################################
+
+DEFAULT_MEMORY_LIMIT_MB = 512
+TALLY_COLUMNS = ['population', 'gop_votes', 'dem_votes']
+
+
+class ChunkConfig:
+    """
+    Memory settings for the chunked pipeline.
+
+    memory_limit_mb: approximate cap on the memory used for unit data
+    rows_per_chunk: (optional) number of units per row group or tile;
+        estimated from a sample of the data and the memory limit if None
+    max_tile_depth: maximum number of times a tile is split into quadrants
+    working_set_factor: ratio of the peak memory used while processing
+        a chunk (projected copies, spatial index, intersections)
+        to the memory of the chunk itself
+    """
+
+    def __init__(self, memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB, rows_per_chunk=None,
+        max_tile_depth=16, working_set_factor=4):
+        self.memory_limit_mb = memory_limit_mb
+        self.rows_per_chunk = rows_per_chunk
+        self.max_tile_depth = max_tile_depth
+        self.working_set_factor = working_set_factor
+
+    @property
+    def memory_limit_bytes(self):
+        return self.memory_limit_mb * 2 ** 20
+
+
+def as_list(fnames):
+    return [fnames] if isinstance(fnames, str) else list(fnames)
+
+
+def zip_path(fname):
+    return fname if 'zip://' in fname or not fname.endswith('.zip') else 'zip://' + fname
+
+
+# Streaming readers
+def iter_shapefile_chunks(shapefile_fnames, rows_per_chunk):
+    """
+    Yields GeoDataFrames (indexed by 'GEOID') of at most
+    rows_per_chunk units at a time from the given shapefile(s).
+    """
+    for fname in as_list(shapefile_fnames):
+        with fiona.open(zip_path(fname)) as source:
+            batch = []
+            for feature in source:
+                batch.append(feature)
+                if len(batch) == rows_per_chunk:
+                    yield gpd.GeoDataFrame.from_features(batch, crs=source.crs).set_index('GEOID')
+                    batch = []
+            if batch:
+                yield gpd.GeoDataFrame.from_features(batch, crs=source.crs).set_index('GEOID')
+
+
+def count_features(shapefile_fnames):
+    """
+    Counts the units in the given shapefile(s)
+    (from the file headers, without reading the units).
+    """
+    count = 0
+    for fname in as_list(shapefile_fnames):
+        with fiona.open(zip_path(fname)) as source:
+            count += len(source)
+    return count
+
+
+def shapefile_crs(shapefile_fnames):
+    """
+    Returns the CRS of the given shapefile(s),
+    which must all be the same.
+    """
+    crs_list = []
+    for fname in as_list(shapefile_fnames):
+        with fiona.open(zip_path(fname)) as source:
+            crs_list.append(source.crs)
+    if any(crs != crs_list[0] for crs in crs_list):
+        raise ValueError('Shapefiles have different CRSs: {0}'.format(crs_list))
+    return crs_list[0]
+
+
+def total_bounds(shapefile_fnames):
+    """
+    Returns the bounds (minx, miny, maxx, maxy) of all units
+    in the given shapefile(s).
+    """
+    bounds = []
+    for fname in as_list(shapefile_fnames):
+        with fiona.open(zip_path(fname)) as source:
+            bounds.append(source.bounds)
+    return (min(b[0] for b in bounds), min(b[1] for b in bounds),
+        max(b[2] for b in bounds), max(b[3] for b in bounds))
+
+
+def iter_csv_chunks(csv_fnames, rows_per_chunk, usecols):
+    """
+    Yields DataFrames of at most rows_per_chunk rows at a time
+    with the given columns of the given CSV file(s).
+    GEOIDs are read as strings.
+    """
+    for fname in as_list(csv_fnames):
+        for chunk in pd.read_csv(fname, usecols=usecols, dtype={'GEOID': str}, chunksize=rows_per_chunk):
+            yield chunk
+
+
+def estimate_rows_per_chunk(shapefile_fnames, config, sample_size=500):
+    """
+    Returns config.rows_per_chunk if set, and otherwise
+    estimates the number of units that fit in the memory limit
+    from the memory used by a sample of units.
+    """
+    if config.rows_per_chunk is not None:
+        return config.rows_per_chunk
+
+    sample = next(iter_shapefile_chunks(shapefile_fnames, sample_size))
+    attribute_bytes = sample.drop(columns='geometry').memory_usage(deep=True).sum()
+    geometry_bytes = sum(len(geometry.wkb) for geometry in sample.geometry) * 2 # Shapely objects are larger than WKB
+    bytes_per_row = (attribute_bytes + geometry_bytes) / len(sample)
+    return max(1, int(config.memory_limit_bytes / (bytes_per_row * config.working_set_factor)))
+
+
+# Adjacency, tile by tile
+def write_adjacency(shapefile_fnames, adjacency_fname, config, crs=None, tmp_dir=None):
+    """
+    Builds the (rook) adjacency of the units in the given shapefile(s)
+    and writes it to a CSV file with columns
+    'GEOID_1', 'GEOID_2', and 'shared_perim', the length of
+    the shared boundary (in units of crs, if given, or the source CRS,
+    e.g., degrees for census shapefiles).
+    These are the same edges as `compactness.compute_boundary_data`;
+    the lengths match its 'edges' only if crs is its (UTM) 'crs'.
+
+    The shapefile(s) are read once: each unit is appended to a spill file
+    (in a temporary directory) for every tile of a grid over all units
+    that its bounding box intersects. Tiles with more than rows_per_chunk
+    units are split into quadrants by streaming only their own spill file.
+    Tiles are then loaded and processed one at a time; each edge is
+    written only by the tile containing a representative point of
+    the shared boundary.
+
+    A tile still holding more than rows_per_chunk units after
+    max_tile_depth splits (e.g., many units around a single point)
+    is processed anyway with a warning, since it cannot be split further.
+
+    Returns the number of edges written.
+    """
+    rows_per_chunk = estimate_rows_per_chunk(shapefile_fnames, config)
+    bounds = total_bounds(shapefile_fnames)
+    outer_max = (bounds[2], bounds[3])
+    source_crs = shapefile_crs(shapefile_fnames)
+    grid_size = max(1, math.ceil(math.sqrt(count_features(shapefile_fnames) / rows_per_chunk)))
+    num_edges = 0
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as spill_dir, open(adjacency_fname, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(['GEOID_1', 'GEOID_2', 'shared_perim'])
+
+        tiles = spill_to_tiles(iter_shapefile_chunks(shapefile_fnames, rows_per_chunk),
+            bounds, grid_size, spill_dir, 'tile')
+        stack = [(tile, spill_fname, count, 0) for tile, spill_fname, count in tiles]
+        while stack:
+            tile, spill_fname, count, depth = stack.pop()
+            if count > rows_per_chunk:
+                if depth < config.max_tile_depth:
+                    subtiles = spill_to_tiles(iter_spill_chunks(spill_fname, rows_per_chunk, source_crs),
+                        tile, 2, spill_dir, os.path.basename(spill_fname)[:-len('.txt')])
+                    os.remove(spill_fname)
+                    stack.extend((subtile, subtile_fname, subtile_count, depth + 1)
+                        for subtile, subtile_fname, subtile_count in subtiles)
+                    continue
+                warnings.warn('Tile {0} has {1} units after {2} splits, more than the {3} allowed by '
+                    'the memory limit; processing it anyway.'.format(tile, count, depth, rows_per_chunk))
+
+            units = pd.concat(list(iter_spill_chunks(spill_fname, count, source_crs)))
+            os.remove(spill_fname)
+            for row in tile_edges(units, tile, outer_max, crs):
+                writer.writerow(row)
+                num_edges += 1
+
+    return num_edges
+
+
+def grid_edges(lower, upper, grid_size):
+    """
+    Returns grid_size + 1 edges from lower to upper (exactly).
+    """
+    width = (upper - lower) / grid_size
+    return [lower + i * width for i in range(grid_size)] + [upper]
+
+
+def spill_to_tiles(chunks, bounds, grid_size, spill_dir, name):
+    """
+    Appends each unit of the given GeoDataFrame chunks
+    (as a line 'GEOID<tab>WKB hex') to the spill file of every tile of
+    a grid_size x grid_size grid over bounds that its (slightly padded)
+    bounding box intersects.
+
+    Returns a list of (tile bounds, spill file name, number of units)
+    for the nonempty tiles.
+    """
+    minx, miny, maxx, maxy = bounds
+    pad = 1e-9 * max(maxx - minx, maxy - miny, 1.)
+    xs = grid_edges(minx, maxx, grid_size)
+    ys = grid_edges(miny, maxy, grid_size)
+    counts = {}
+
+    def spill_fname(i, j):
+        return os.path.join(spill_dir, '{0}_{1}_{2}.txt'.format(name, i, j))
+
+    for chunk in chunks:
+        lines = {}
+        for geoid, geometry in zip(chunk.index, chunk.geometry):
+            unit_minx, unit_miny, unit_maxx, unit_maxy = geometry.bounds
+            line = '{0}\t{1}\n'.format(geoid, geometry.wkb_hex)
+            for i in range(grid_size):
+                if unit_minx > xs[i + 1] + pad or unit_maxx < xs[i] - pad:
+                    continue
+                for j in range(grid_size):
+                    if unit_miny > ys[j + 1] + pad or unit_maxy < ys[j] - pad:
+                        continue
+                    lines.setdefault((i, j), []).append(line)
+
+        for (i, j), tile_lines in lines.items():
+            with open(spill_fname(i, j), 'a') as spill_file:
+                spill_file.writelines(tile_lines)
+            counts[i, j] = counts.get((i, j), 0) + len(tile_lines)
+
+    return [((xs[i], ys[j], xs[i + 1], ys[j + 1]), spill_fname(i, j), count)
+        for (i, j), count in counts.items()]
+
+
+def iter_spill_chunks(spill_fname, rows_per_chunk, source_crs):
+    """
+    Yields GeoDataFrames (indexed by 'GEOID') of at most
+    rows_per_chunk units at a time from a spill file.
+    """
+    def to_gdf(geoids, wkbs):
+        geometry = gpd.GeoSeries.from_wkb([bytes.fromhex(wkb) for wkb in wkbs], crs=source_crs)
+        return gpd.GeoDataFrame({'GEOID': geoids}, geometry=geometry, crs=source_crs).set_index('GEOID')
+
+    geoids = []
+    wkbs = []
+    with open(spill_fname, 'r') as spill_file:
+        for line in spill_file:
+            geoid, wkb = line.rstrip('\n').split('\t')
+            geoids.append(geoid)
+            wkbs.append(wkb)
+            if len(geoids) == rows_per_chunk:
+                yield to_gdf(geoids, wkbs)
+                geoids = []
+                wkbs = []
+    if geoids:
+        yield to_gdf(geoids, wkbs)
+
+
+def tile_contains(tile, point, outer_max):
+    """
+    Returns True if the given point is in the half-open tile
+    [minx, maxx) x [miny, maxy). Tiles on the outer edge of
+    all units (outer_max = (maxx, maxy)) also include that edge,
+    so the tiles partition the plane exactly.
+    """
+    minx, miny, maxx, maxy = tile
+    in_x = minx <= point.x < maxx or (point.x == maxx == outer_max[0])
+    in_y = miny <= point.y < maxy or (point.y == maxy == outer_max[1])
+    return in_x and in_y
+
+
+def tile_edges(units, tile, outer_max, crs=None):
+    """
+    Yields [GEOID_1, GEOID_2, shared_perim] for each pair of
+    the given units sharing a boundary of positive length
+    whose representative point lies in the given tile.
+    """
+    geometries = units.geometry.values
+    projected = units.to_crs(crs).geometry.values if crs is not None else geometries
+    geoids = list(units.index)
+
+    left, right = units.sindex.query_bulk(units.geometry, predicate='intersects')
+    for i, j in zip(left, right):
+        if geoids[i] >= geoids[j]:
+            continue
+        shared = geometries[i].intersection(geometries[j])
+        if shared.length == 0 or not tile_contains(tile, shared.representative_point(), outer_max):
+            continue
+        shared_perim = shared.length if crs is None else projected[i].intersection(projected[j]).length
+        yield [geoids[i], geoids[j], shared_perim]
+
+
+def read_adjacency(adjacency_fname):
+    """
+    Reads an adjacency file written by `write_adjacency`
+    into a DataFrame.
+    """
+    return pd.read_csv(adjacency_fname, dtype={'GEOID_1': str, 'GEOID_2': str})
+
+
+# District tallies, accumulated partition by partition
+def partition_csv_by_geoid(csv_fnames, usecols, num_buckets, out_dir, rows_per_chunk, name):
+    """
+    Streams the given CSV file(s) and appends each row to one of
+    num_buckets CSV files in out_dir according to a hash of its GEOID,
+    so that rows of different files with the same GEOID land in
+    buckets with the same index.
+
+    Returns the list of bucket file names (some may not exist if empty).
+    """
+    bucket_fnames = [os.path.join(out_dir, '{0}_{1}.csv'.format(name, i)) for i in range(num_buckets)]
+    for chunk in iter_csv_chunks(csv_fnames, rows_per_chunk, usecols):
+        buckets = pd.util.hash_pandas_object(chunk['GEOID'], index=False) % num_buckets
+        for bucket, bucket_df in chunk.groupby(buckets.values):
+            fname = bucket_fnames[bucket]
+            bucket_df.to_csv(fname, mode='a', header=not os.path.exists(fname), index=False)
+    return bucket_fnames
+
+
+def read_bucket(fname, columns):
+    if not os.path.exists(fname):
+        return pd.DataFrame(columns=columns).set_index('GEOID')
+    return pd.read_csv(fname, dtype={'GEOID': str}).set_index('GEOID')
+
+
+def accumulate_tallies(assignment_fnames, pop_fnames, voteshares_fnames, config, tmp_dir=None):
+    """
+    Computes the population, GOP votes, and Democratic votes of each district
+    from assignment CSV file(s) ('GEOID', 'district'),
+    population CSV file(s) ('GEOID', 'population'), and
+    voteshare CSV file(s) ('GEOID', 'gop_voteshare', 'dem_voteshare'),
+    as `add_population_data` and `add_voteshare_data` would,
+    without loading all units at once.
+
+    The CSV files are hash-partitioned by GEOID into buckets small enough
+    to fit in the memory limit, and the buckets are joined and tallied
+    one at a time. Units missing from the assignment are tallied
+    under district -1. (Unlike `build_partition`, they are not assigned
+    to a neighboring district, which would need the adjacency graph;
+    the district tallies therefore match `build_partition` only when
+    district -1 is empty or has no population.)
+
+    Returns a tuple (tallies, total_population), where tallies is
+    a DataFrame indexed by district with the columns in TALLY_COLUMNS.
+    """
+    rows_per_chunk = config.rows_per_chunk or max(1, config.memory_limit_bytes // (200 * config.working_set_factor))
+    input_bytes = sum(os.path.getsize(fname) for fname in
+        as_list(assignment_fnames) + as_list(pop_fnames) + as_list(voteshares_fnames))
+    # DataFrames take several times the memory of the CSV text
+    num_buckets = max(1, math.ceil(input_bytes * config.working_set_factor / config.memory_limit_bytes))
+
+    tallies = pd.DataFrame(columns=TALLY_COLUMNS, dtype=float)
+    total_population = 0.
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as bucket_dir:
+        assignment_buckets = partition_csv_by_geoid(assignment_fnames, ['GEOID', 'district'],
+            num_buckets, bucket_dir, rows_per_chunk, 'assignment')
+        pop_buckets = partition_csv_by_geoid(pop_fnames, ['GEOID', 'population'],
+            num_buckets, bucket_dir, rows_per_chunk, 'population')
+        voteshare_buckets = partition_csv_by_geoid(voteshares_fnames, ['GEOID', 'gop_voteshare', 'dem_voteshare'],
+            num_buckets, bucket_dir, rows_per_chunk, 'voteshares')
+
+        for i in range(num_buckets):
+            units = read_bucket(pop_buckets[i], ['GEOID', 'population'])
+            units = units.join(read_bucket(voteshare_buckets[i], ['GEOID', 'gop_voteshare', 'dem_voteshare']))
+            units = units.join(read_bucket(assignment_buckets[i], ['GEOID', 'district']))
+            units['district'] = units['district'].fillna(-1).astype(int)
+            units['gop_votes'] = units['gop_voteshare'] * units['population']
+            units['dem_votes'] = units['dem_voteshare'] * units['population']
+
+            total_population += units['population'].sum()
+            tallies = tallies.add(units.groupby('district')[TALLY_COLUMNS].sum(), fill_value=0)
+
+    tallies.index = tallies.index.astype(int)
+    tallies.index.name = 'district'
+    return tallies.sort_index(), total_population
+
+
+def compute_plan_metrics(tallies, total_population):
+    """
+    Given district tallies and the total population
+    (from `accumulate_tallies`), computes the same plan metrics as
+    `helpers.compute_SL_index`, `helpers.compute_efficiency_gap`,
+    and `helpers.compute_mm_gap`.
+    """
+    assigned = tallies[tallies.index != -1]
+    gop_votes = assigned['gop_votes'].tolist()
+    dem_votes = assigned['dem_votes'].tolist()
+    return {
+        'SL_index': helpers.SL_votes_helper(gop_votes, dem_votes),
+        # Using total population as a proxy for total_votes, as in `helpers.compute_efficiency_gap`
+        'efficiency_gap': helpers.EG_helper(gop_votes, dem_votes, total_population),
+        'mm_gap': helpers.MM_helper(gop_votes, dem_votes)
+    }
+
+
+if __name__ == "__main__":
+    # Check that the chunked path matches the in-memory path on tracts,
+    # with a memory limit small enough to force many tiles and buckets
+    tracts_fname = 'data/tl_2013_55_tract.zip'
+    dem_assignment_fname = 'data/wi_gerrymander_dem.csv'
+    population_fname = 'data/wi_tract_populations_census_2010.csv'
+    voteshares_fname = 'data/wi_voteshares.csv'
+    adjacency_fname = 'wi_tract_adjacency.csv'
+
+    config = ChunkConfig(memory_limit_mb=1, rows_per_chunk=100)
+    dem_plan = helpers.build_district_plan(tracts_fname, dem_assignment_fname, population_fname, voteshares_fname)
+
+    num_edges = write_adjacency(tracts_fname, adjacency_fname, config)
+    chunked_edges = {frozenset(edge) for edge in read_adjacency(adjacency_fname)[['GEOID_1', 'GEOID_2']].values}
+    in_memory_edges = {frozenset(edge) for edge in dem_plan.graph.edges}
+    print('Edges: {0} chunked, {1} in memory, {2} in only one'.format(
+        num_edges, len(in_memory_edges), len(chunked_edges ^ in_memory_edges)))
+
+    tallies, total_population = accumulate_tallies(dem_assignment_fname, population_fname, voteshares_fname, config)
+    # Units missing from the assignment are tallied under -1 here but
+    # assigned to a neighboring district by `build_partition`
+    unassigned = tallies.loc[-1] if -1 in tallies.index else pd.Series(0., index=TALLY_COLUMNS)
+    print('Unassigned (district -1): ' + ', '.join('{0} {1:.2f}'.format(column, unassigned[column]) for column in TALLY_COLUMNS))
+    print('Total population: {0:.0f} chunked, {1:.0f} in memory'.format(
+        total_population, sum(dem_plan['population'].values())))
+    for column in TALLY_COLUMNS:
+        max_diff = max(abs(tallies.loc[part, column] - dem_plan[column][part]) for part in dem_plan.parts)
+        print('{0}: max difference {1:.2e}'.format(column, max_diff))
+
+    chunked_metrics = compute_plan_metrics(tallies, total_population)
+    for fn_name, metric_name in [('compute_SL_index', 'SL_index'), ('compute_efficiency_gap', 'efficiency_gap'), ('compute_mm_gap', 'mm_gap')]:
+        metric_val = getattr(helpers, fn_name)(dem_plan)
+        print('\t{0}: {1:.6f} chunked, {2:.6f} in memory'.format(metric_name, chunked_metrics[metric_name], metric_val))
@@ -0,0 +1,449 @@
+import json
+import math
+import random
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+import gerrychain
+
+######################################################################
+#
+# Compactness metrics (Polsby-Popper and Reock) for district plans
+# computed from precomputed tract boundary data
+#
+# Dissolving tract geometry for every plan of an ensemble is slow,
+# so the tract areas, exterior perimeters, and shared-boundary
+# lengths of the dual graph's edges are computed once with
+# `compute_boundary_data` and attached to a gerrychain.Graph.
+# District perimeters are then sums over cut edges and are
+# updated in O(degree) time per flip.
+#
+# gerrychain 0.2.17 has similar `perimeter` and `polsby_popper`
+# updaters, fed by `Graph.from_geodataframe(..., reproject=True)`.
+# They are not used here because that recomputes the projected
+# geometry every time a graph is built (e.g., for each plan in
+# `build_district_plan`), while the boundary data here is computed
+# once, saved as JSON, and also holds the convex hulls Reock needs
+# in the same projection.
+#
+######################################################################
+
+
+def compute_boundary_data(gdf, crs=None):
+    """
+    Given a GeoDataFrame of units (e.g., tracts from `load_shapefile`),
+    computes the boundary data needed for compactness metrics.
+
+    Geometry is projected to the given crs first,
+    since areas and lengths in degrees are meaningless.
+    If crs is None, then the UTM zone of the data is used.
+
+    Returns a dictionary (JSON serializable) with keys
+        'crs': the projected CRS used for all areas and lengths,
+        'area': dict mapping each GEOID to its area,
+        'boundary_perim': dict mapping each GEOID to the length
+            of its boundary not shared with any other unit,
+        'hull': dict mapping each GEOID to the vertices of
+            its convex hull (used for Reock scores),
+        'edges': list of [GEOID_1, GEOID_2, shared_perim]
+            for each pair of units sharing a boundary of positive length.
+    """
+    if crs is None:
+        crs = gdf.estimate_utm_crs()
+    projected = gdf.to_crs(crs)
+    geometries = projected.geometry.values
+    geoids = list(projected.index)
+
+    edges = []
+    shared_totals = np.zeros(len(geoids))
+
+    # Candidate pairs come from the spatial index;
+    # only pairs sharing a boundary of positive length are edges (rook adjacency).
+    left, right = projected.sindex.query_bulk(projected.geometry, predicate='intersects')
+    for i, j in zip(left, right):
+        if i >= j:
+            continue
+        shared_perim = geometries[i].intersection(geometries[j]).length
+        if shared_perim > 0:
+            edges.append([geoids[i], geoids[j], shared_perim])
+            shared_totals[i] += shared_perim
+            shared_totals[j] += shared_perim
+
+    perimeters = projected.geometry.length.values
+    boundary_perims = np.clip(perimeters - shared_totals, 0, None)
+
+    hulls = {}
+    for geoid, hull in zip(geoids, projected.geometry.convex_hull):
+        if hull.geom_type == 'Polygon':
+            hulls[geoid] = [list(point) for point in hull.exterior.coords[:-1]]
+        else: # Degenerate hull (Point or LineString)
+            hulls[geoid] = [list(point) for point in hull.coords]
+
+    return {
+        'crs': str(crs),
+        'area': dict(zip(geoids, projected.geometry.area.values.tolist())),
+        'boundary_perim': dict(zip(geoids, boundary_perims.tolist())),
+        'hull': hulls,
+        'edges': edges
+    }
+
+
+def save_boundary_data(boundary_data, fname='boundary_data.json'):
+    """
+    Saves the given boundary data (from `compute_boundary_data`) to a file.
+    """
+    with open(fname, 'w') as outfile:
+        json.dump(boundary_data, outfile)
+
+
+def load_boundary_data(fname):
+    """
+    Loads boundary data saved by `save_boundary_data`.
+    """
+    with open(fname, 'r') as infile:
+        return json.load(infile)
+
+
+def add_boundary_data(graph, boundary_data):
+    """
+    Adds the given boundary data (from `compute_boundary_data`)
+    to the nodes and edges of the given gerrychain.Graph as
+    'area', 'boundary_perim', and 'hull' node attributes and
+    'shared_perim' edge attributes.
+
+    Edges of the graph without a shared boundary of positive length
+    in the boundary data (e.g., units meeting at a single point)
+    get a 'shared_perim' of 0. Conversely, edges of the boundary data
+    missing from the graph (whose rook adjacency is computed from
+    unprojected geometry, so tiny contacts may differ) are added back
+    to the 'boundary_perim' of both units, since `compute_boundary_data`
+    subtracted them, and they are never cut edges.
+    Any 'area' or 'shared_perim' attributes already set by
+    gerrychain.Graph.from_geodataframe (in unprojected units)
+    are overwritten.
+    """
+    for node in graph.nodes:
+        graph.nodes[node]['area'] = boundary_data['area'].get(node, 0.)
+        graph.nodes[node]['boundary_perim'] = boundary_data['boundary_perim'].get(node, 0.)
+        graph.nodes[node]['hull'] = boundary_data['hull'].get(node, [])
+
+    for u, v in graph.edges:
+        graph.edges[u, v]['shared_perim'] = 0.
+
+    for u, v, shared_perim in boundary_data['edges']:
+        if graph.has_edge(u, v):
+            graph.edges[u, v]['shared_perim'] = shared_perim
+        else:
+            for node in (u, v):
+                if node in graph.nodes:
+                    graph.nodes[node]['boundary_perim'] += shared_perim
+
+
+# Partition updaters
+def district_perimeters(partition):
+    """
+    Partition updater computing the perimeter of each district.
+
+    The perimeter of a district is the exterior boundary length
+    of its units plus the shared-boundary lengths of its cut edges.
+    For partitions produced by flips, the parent's perimeters are
+    updated using only the edges incident to the flipped units.
+    """
+    if partition.parent is None:
+        return initial_district_perimeters(partition)
+
+    graph = partition.graph
+    parent_assignment = partition.parent.assignment
+    perimeters = dict(partition.parent['perimeter'])
+    flipped = {}
+
+    for node, new_part in partition.flips.items():
+        old_part = flipped.get(node, parent_assignment[node])
+        if old_part == new_part:
+            continue
+
+        boundary_perim = graph.nodes[node]['boundary_perim']
+        perimeters[old_part] -= boundary_perim
+        perimeters[new_part] = perimeters.get(new_part, 0.) + boundary_perim
+
+        for neighbor in graph.neighbors(node):
+            shared_perim = graph.edges[node, neighbor]['shared_perim']
+            neighbor_part = flipped.get(neighbor, parent_assignment[neighbor])
+            if neighbor_part == old_part: # Edge becomes cut
+                perimeters[old_part] += shared_perim
+                perimeters[new_part] += shared_perim
+            elif neighbor_part == new_part: # Edge is no longer cut
+                perimeters[old_part] -= shared_perim
+                perimeters[new_part] -= shared_perim
+            else: # Edge stays cut, but now borders new_part instead of old_part
+                perimeters[old_part] -= shared_perim
+                perimeters[new_part] += shared_perim
+
+        flipped[node] = new_part
+
+    # Drop districts emptied by the flips
+    for part in set(parent_assignment[node] for node in partition.flips):
+        if not is_nonempty_part(partition, part):
+            perimeters.pop(part, None)
+
+    return perimeters
+
+
+def initial_district_perimeters(partition):
+    """
+    Computes the perimeter of each district of the given partition
+    from scratch (see `district_perimeters`).
+    """
+    graph = partition.graph
+    perimeters = {part: 0. for part in partition.parts}
+
+    for node in graph.nodes:
+        perimeters[partition.assignment[node]] += graph.nodes[node]['boundary_perim']
+
+    for u, v in graph.edges:
+        u_part = partition.assignment[u]
+        v_part = partition.assignment[v]
+        if u_part != v_part:
+            shared_perim = graph.edges[u, v]['shared_perim']
+            perimeters[u_part] += shared_perim
+            perimeters[v_part] += shared_perim
+
+    return perimeters
+
+
+def enclosing_circles(partition):
+    """
+    Partition updater computing the minimum enclosing circle
+    (center x, center y, radius) of each district.
+
+    Only units on the boundary of a district can touch its
+    enclosing circle, so the circle is computed from the convex hulls
+    of those units. For partitions produced by flips, only the
+    districts gaining or losing units are recomputed.
+    """
+    if partition.parent is None:
+        parts = list(partition.parts)
+        circles = {}
+    else:
+        parts = set(partition.flips.values())
+        parts.update(partition.parent.assignment[node] for node in partition.flips)
+        circles = dict(partition.parent['enclosing_circle'])
+
+    graph = partition.graph
+    for part in parts:
+        if not is_nonempty_part(partition, part): # District emptied by the flips
+            circles.pop(part, None)
+            continue
+        points = []
+        for node in partition.parts[part]:
+            on_boundary = graph.nodes[node]['boundary_perim'] > 0 or any(
+                partition.assignment[neighbor] != part for neighbor in graph.neighbors(node))
+            if on_boundary:
+                points.extend(graph.nodes[node]['hull'])
+        circles[part] = minimum_enclosing_circle(points)
+
+    return circles
+
+
+def polsby_popper(partition):
+    """
+    Partition updater computing the Polsby-Popper score
+    4 * pi * area / perimeter^2 of each district.
+    Empty districts (zero perimeter) are skipped.
+
+    Reference: Polsby and Popper. "The third criterion: Compactness
+    as a procedural safeguard against partisan gerrymandering." 1991.
+    """
+    return {part: 4 * math.pi * partition['area'][part] / partition['perimeter'][part] ** 2
+        for part in partition.parts if partition['perimeter'].get(part, 0.) > 0}
+
+
+def reock(partition):
+    """
+    Partition updater computing the Reock score
+    area / (area of minimum enclosing circle) of each district.
+    Empty districts (zero radius) are skipped.
+
+    Reference: Reock. "A note: Measuring compactness as
+    a requirement of legislative apportionment." 1961.
+    """
+    circles = partition['enclosing_circle']
+    return {part: partition['area'][part] / (math.pi * circles[part][2] ** 2)
+        for part in partition.parts if part in circles and circles[part][2] > 0}
+
+
+def is_nonempty_part(partition, part):
+    """
+    Returns True if the given district of the partition has any units.
+    """
+    return part in partition.parts and len(partition.parts[part]) > 0
+
+
+def compactness_updaters():
+    """
+    Returns the dictionary of partition updaters needed for
+    Polsby-Popper and Reock scores.
+    The partition's graph must have boundary data
+    (see `add_boundary_data`).
+    """
+    return {
+        'area': gerrychain.updaters.Tally('area'),
+        'perimeter': district_perimeters,
+        'enclosing_circle': enclosing_circles,
+        'polsby_popper': polsby_popper,
+        'reock': reock
+    }
+
+
+def minimum_enclosing_circle(points):
+    """
+    Given a list of (x, y) points,
+    computes and returns the minimum enclosing circle
+    as a tuple (center x, center y, radius)
+    using Welzl's randomized incremental algorithm.
+
+    Reference: E. Welzl. "Smallest enclosing disks
+    (balls and ellipsoids)." 1991.
+    """
+    points = [(float(x), float(y)) for x, y in points]
+    if not points:
+        return (0., 0., 0.)
+    random.Random(0).shuffle(points) # Fixed seed keeps results reproducible
+
+    circle = (points[0][0], points[0][1], 0.)
+    for i in range(1, len(points)):
+        p = points[i]
+        if in_circle(circle, p):
+            continue
+        circle = (p[0], p[1], 0.)
+        for j in range(i):
+            q = points[j]
+            if in_circle(circle, q):
+                continue
+            circle = circle_from_two_points(p, q)
+            for k in range(j):
+                r = points[k]
+                if not in_circle(circle, r):
+                    circle = circle_from_three_points(p, q, r)
+
+    return circle
+
+
+def in_circle(circle, point, rel_tol=1e-9):
+    """
+    Returns True if the given point lies in the given circle
+    (center x, center y, radius), up to a small relative tolerance.
+    """
+    return math.hypot(point[0] - circle[0], point[1] - circle[1]) <= circle[2] * (1 + rel_tol) + rel_tol
+
+
+def circle_from_two_points(p, q):
+    """
+    Returns the smallest circle with p and q on its boundary.
+    """
+    cx = (p[0] + q[0]) / 2
+    cy = (p[1] + q[1]) / 2
+    return (cx, cy, math.hypot(p[0] - cx, p[1] - cy))
+
+
+def circle_from_three_points(p, q, r):
+    """
+    Returns the circumcircle of p, q, and r.
+    If the points are collinear,
+    returns the circle on the farthest pair instead.
+    """
+    d = 2 * (p[0] * (q[1] - r[1]) + q[0] * (r[1] - p[1]) + r[0] * (p[1] - q[1]))
+    if d == 0:
+        pairs = [(p, q), (p, r), (q, r)]
+        return max((circle_from_two_points(a, b) for a, b in pairs), key=lambda circle: circle[2])
+
+    p_sq = p[0] ** 2 + p[1] ** 2
+    q_sq = q[0] ** 2 + q[1] ** 2
+    r_sq = r[0] ** 2 + r[1] ** 2
+    cx = (p_sq * (q[1] - r[1]) + q_sq * (r[1] - p[1]) + r_sq * (p[1] - q[1])) / d
+    cy = (p_sq * (r[0] - q[0]) + q_sq * (p[0] - r[0]) + r_sq * (q[0] - p[0])) / d
+    return (cx, cy, math.hypot(p[0] - cx, p[1] - cy))
+
+
+def dissolved_compactness(district_gdf, crs):
+    """
+    Given a GeoDataFrame with one (dissolved) geometry per district,
+    computes Polsby-Popper and Reock scores directly from the geometry
+    after projecting to the given crs.
+
+    Returns a DataFrame indexed like district_gdf with
+    'polsby_popper' and 'reock' columns.
+    """
+    projected = district_gdf.to_crs(crs)
+    polsby_popper_scores = []
+    reock_scores = []
+
+    for geometry in projected.geometry:
+        polsby_popper_scores.append(4 * math.pi * geometry.area / geometry.length ** 2)
+        hull = geometry.convex_hull
+        circle = minimum_enclosing_circle(hull.exterior.coords[:-1])
+        reock_scores.append(geometry.area / (math.pi * circle[2] ** 2))
+
+    return pd.DataFrame({'polsby_popper': polsby_popper_scores, 'reock': reock_scores},
+        index=projected.index)
+
+
+def compare_with_dissolved_plan(partition, plan_fname, crs):
+    """
+    Compares the compactness scores of the given partition
+    (built with compactness updaters) against scores computed from
+    the dissolved district geometry in the given plan GeoJSON file,
+    e.g., 'geojson/wi_map_plan_1.geojson'.
+
+    Returns a DataFrame indexed by district with both sets of scores
+    and their absolute differences.
+    """
+    plan_gdf = gpd.read_file(plan_fname)
+    plan_gdf = plan_gdf[plan_gdf['district'] > 0].set_index('district')
+    dissolved_df = dissolved_compactness(plan_gdf, crs)
+
+    comparison_df = pd.DataFrame({
+        'polsby_popper': pd.Series(partition['polsby_popper']),
+        'polsby_popper_dissolved': dissolved_df['polsby_popper'],
+        'reock': pd.Series(partition['reock']),
+        'reock_dissolved': dissolved_df['reock']
+        })
+    comparison_df['polsby_popper_diff'] = (comparison_df['polsby_popper'] - comparison_df['polsby_popper_dissolved']).abs()
+    comparison_df['reock_diff'] = (comparison_df['reock'] - comparison_df['reock_dissolved']).abs()
+    return comparison_df
+
+
+if __name__ == "__main__":
+    import helpers
+
+    tracts_fname = 'zip://data/tl_2013_55_tract.zip'
+    path_fname = 'data/wi_path_100flips.json'
+    boundary_fname = 'data/wi_tract_boundaries.json'
+    plan_fname = 'geojson/wi_map_plan_{}.geojson'
+
+    # One-time precomputation.
+    # The plan GeoJSON files leave water-only tracts unassigned (district -1),
+    # so only tracts on the path are kept for the comparison to line up.
+    gdf = helpers.load_shapefile(tracts_fname)
+    initial_assignment = next(helpers.read_path_of_maps(path_fname))
+    gdf = gdf[gdf.index.isin(initial_assignment.keys())]
+    boundary_data = compute_boundary_data(gdf)
+    save_boundary_data(boundary_data, boundary_fname)
+
+    # Walk the flip path, checking a few plans against their dissolved geometry
+    partition = None
+    for plan_number, assignment in enumerate(helpers.read_path_of_maps(path_fname), start=1):
+        if partition is None:
+            partition = helpers.build_partition(gdf, assignment_dict=assignment, boundary_data=boundary_data)
+        else:
+            flips = {node: assignment[node] for node in assignment if assignment[node] != partition.assignment[node]}
+            partition = partition.flip(flips)
+
+        if plan_number in (1, 42, 83):
+            comparison_df = compare_with_dissolved_plan(partition, plan_fname.format(plan_number), boundary_data['crs'])
+            print('\n~~~ Plan {0} compactness ~~~'.format(plan_number))
+            print(comparison_df.round(6))
+            print('\tMax Polsby-Popper difference: {0:.2e}'.format(comparison_df['polsby_popper_diff'].max()))
+            print('\tMax Reock difference: {0:.2e}'.format(comparison_df['reock_diff'].max()))
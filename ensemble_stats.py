@@ -0,0 +1,493 @@
+import json
+import math
+import warnings
+
+import geopandas
+import pandas as pd
+
+import helpers
+
+######################################################################
+#
+# Streaming statistics over ensembles of district plans
+#
+# Metric records (dictionaries of metric name to value) are ingested
+# one at a time from chains or stored plans and summarized in memory
+# that does not grow with the number of plans. Aggregators from
+# parallel workers merge exactly: the merged summary is identical to
+# the summary of all records ingested by a single aggregator.
+#
+######################################################################
+
+METRIC_NAMES = ['SL_index', 'efficiency_gap', 'mm_gap']
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with relative-error guarantees (DDSketch).
+
+    Each value x is counted in the bucket (gamma^(i-1), gamma^i] containing |x|,
+    with gamma = (1 + relative_accuracy) / (1 - relative_accuracy),
+    so that quantiles are accurate to within relative_accuracy.
+    Values with |x| < min_value are counted as zero.
+
+    Each sign keeps at most max_buckets buckets: when the buckets of a sign
+    span more indices than that, the lowest-magnitude buckets are merged
+    into the lowest one kept. Memory is therefore bounded by
+    2 * max_buckets + 1 counts regardless of the number of values.
+    The relative accuracy holds for values within a factor of
+    gamma^max_buckets (about e^(2 * relative_accuracy * max_buckets))
+    of the largest magnitude of their sign; smaller magnitudes are
+    reported as that bound. Finer accuracy thus covers a narrower range
+    of magnitudes for the same memory; the defaults cover a factor of
+    about 60 at 0.1% accuracy. A warning is issued the first time
+    buckets are merged, since quantiles below the bound are then wrong.
+
+    The merged bucket only depends on the largest index seen, so merging
+    two sketches (adding counts, then merging low buckets) gives exactly
+    the sketch of all their values.
+
+    Reference: Masson, Rim, and Lee. "DDSketch: A fast and fully-mergeable
+    quantile sketch with relative-error guarantees." 2019.
+    """
+
+    def __init__(self, relative_accuracy=1e-3, min_value=1e-12, max_buckets=2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('relative_accuracy must be in (0, 1), but is {0}.'.format(relative_accuracy))
+        if max_buckets < 1:
+            raise ValueError('max_buckets must be positive, but is {0}.'.format(max_buckets))
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+        self.positive = {} # Bucket index to count, for values >= min_value
+        self.negative = {} # Bucket index (of |x|) to count, for values <= -min_value
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.has_collapsed = False
+
+    def bucket_index(self, magnitude):
+        return math.ceil(math.log(magnitude) / self.log_gamma)
+
+    def bucket_value(self, index):
+        """
+        Returns the representative magnitude of the given bucket,
+        which is within relative_accuracy of every magnitude in the bucket.
+        """
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def collapse(self, store):
+        """
+        Merges the lowest-magnitude buckets of the given store
+        so that it spans at most max_buckets indices.
+        """
+        lowest_kept = max(store) - self.max_buckets + 1
+        if min(store) >= lowest_kept:
+            return
+        collapsed = 0
+        for index in [index for index in store if index < lowest_kept]:
+            collapsed += store.pop(index)
+        store[lowest_kept] = store.get(lowest_kept, 0) + collapsed
+
+        if not self.has_collapsed:
+            self.has_collapsed = True
+            warnings.warn('QuantileSketch merged its lowest buckets: with relative_accuracy {0} and '
+                'max_buckets {1}, magnitudes more than {2:.3g} times smaller than the largest are '
+                'not resolved. Use a coarser relative_accuracy or more buckets.'.format(
+                self.relative_accuracy, self.max_buckets, self.gamma ** self.max_buckets))
+
+    def add_to_store(self, store, index, count):
+        if index in store:
+            store[index] += count
+        else:
+            store[index] = count
+            self.collapse(store)
+
+    def add(self, value, count=1):
+        if value >= self.min_value:
+            self.add_to_store(self.positive, self.bucket_index(value), count)
+        elif value <= -self.min_value:
+            self.add_to_store(self.negative, self.bucket_index(-value), count)
+        else:
+            self.zero_count += count
+
+        self.count += count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """
+        Adds the counts of the other sketch to this sketch.
+        Both sketches must have the same parameters.
+        """
+        if (self.relative_accuracy, self.min_value, self.max_buckets) != (other.relative_accuracy, other.min_value, other.max_buckets):
+            raise ValueError('Cannot merge sketches with different relative_accuracy, min_value, or max_buckets.')
+
+        for store, other_store in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for index, count in other_store.items():
+                store[index] = store.get(index, 0) + count
+            if store:
+                self.collapse(store)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def sorted_buckets(self):
+        """
+        Returns a list of (lower, upper, representative value, count)
+        tuples for all nonempty buckets in increasing order of value.
+        """
+        buckets = []
+        for index in sorted(self.negative, reverse=True):
+            buckets.append((-self.gamma ** index, -self.gamma ** (index - 1), -self.bucket_value(index), self.negative[index]))
+        if self.zero_count:
+            buckets.append((-self.min_value, self.min_value, 0., self.zero_count))
+        for index in sorted(self.positive):
+            buckets.append((self.gamma ** (index - 1), self.gamma ** index, self.bucket_value(index), self.positive[index]))
+        return buckets
+
+    def quantile(self, q):
+        """
+        Returns an estimate of the q-quantile (0 <= q <= 1) of the values.
+        """
+        if self.count == 0:
+            raise ValueError('Cannot compute a quantile of an empty sketch.')
+        if not 0 <= q <= 1:
+            raise ValueError('q must be in [0, 1], but is {0}.'.format(q))
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for lower, upper, value, count in self.sorted_buckets():
+            seen += count
+            if seen > rank:
+                # Clamp so the extremes are reported exactly
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def percentile_rank(self, value):
+        """
+        Returns an estimate of the fraction of values below the given value,
+        counting values in the same bucket as half below.
+        """
+        if self.count == 0:
+            raise ValueError('Cannot compute a percentile rank of an empty sketch.')
+        if value < self.min:
+            return 0.
+        if value > self.max:
+            return 1.
+
+        below = 0
+        for lower, upper, bucket_value, count in self.sorted_buckets():
+            if upper < value:
+                below += count
+            elif lower <= value:
+                below += 0.5 * count
+        return below / self.count
+
+    def to_dict(self):
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'min_value': self.min_value,
+            'max_buckets': self.max_buckets,
+            'positive': {str(index): count for index, count in self.positive.items()},
+            'negative': {str(index): count for index, count in self.negative.items()},
+            'zero_count': self.zero_count,
+            'count': self.count,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None
+        }
+
+    @classmethod
+    def from_dict(cls, sketch_dict):
+        sketch = cls(sketch_dict['relative_accuracy'], sketch_dict['min_value'], sketch_dict['max_buckets'])
+        sketch.positive = {int(index): count for index, count in sketch_dict['positive'].items()}
+        sketch.negative = {int(index): count for index, count in sketch_dict['negative'].items()}
+        sketch.zero_count = sketch_dict['zero_count']
+        sketch.count = sketch_dict['count']
+        if sketch.count:
+            sketch.min = sketch_dict['min']
+            sketch.max = sketch_dict['max']
+        return sketch
+
+
+class Histogram:
+    """
+    Fixed-bin histogram of values in [lower, upper],
+    with counts of values outside the range kept separately.
+    Histograms with the same bins merge by adding counts.
+    """
+
+    def __init__(self, lower, upper, num_bins=20):
+        if not lower < upper:
+            raise ValueError('lower must be less than upper, but they are {0} and {1}.'.format(lower, upper))
+        self.lower = lower
+        self.upper = upper
+        self.num_bins = num_bins
+        self.counts = [0] * num_bins
+        self.underflow = 0
+        self.overflow = 0
+
+    def add(self, value, count=1):
+        if value < self.lower:
+            self.underflow += count
+        elif value > self.upper:
+            self.overflow += count
+        else:
+            index = int((value - self.lower) / (self.upper - self.lower) * self.num_bins)
+            self.counts[min(index, self.num_bins - 1)] += count # upper itself goes in the last bin
+
+    def merge(self, other):
+        if (self.lower, self.upper, self.num_bins) != (other.lower, other.upper, other.num_bins):
+            raise ValueError('Cannot merge histograms with different bins.')
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+
+    def bin_edges(self):
+        width = (self.upper - self.lower) / self.num_bins
+        return [self.lower + i * width for i in range(self.num_bins)] + [self.upper]
+
+    def to_df(self):
+        """
+        Returns a DataFrame with 'bin_start', 'bin_end', and 'count' columns.
+        """
+        edges = self.bin_edges()
+        return pd.DataFrame({'bin_start': edges[:-1], 'bin_end': edges[1:], 'count': self.counts})
+
+    def to_dict(self):
+        return {
+            'lower': self.lower,
+            'upper': self.upper,
+            'num_bins': self.num_bins,
+            'counts': self.counts,
+            'underflow': self.underflow,
+            'overflow': self.overflow
+        }
+
+    @classmethod
+    def from_dict(cls, histogram_dict):
+        histogram = cls(histogram_dict['lower'], histogram_dict['upper'], histogram_dict['num_bins'])
+        histogram.counts = list(histogram_dict['counts'])
+        histogram.underflow = histogram_dict['underflow']
+        histogram.overflow = histogram_dict['overflow']
+        return histogram
+
+
+class EnsembleAggregator:
+    """
+    Summarizes a stream of metric records (dictionaries of
+    metric name to value, e.g., rows of 'geojson/all_plan_metrics')
+    with a QuantileSketch per metric and, for metrics with a given
+    (lower, upper) range in histogram_ranges, a fixed-bin Histogram.
+    """
+
+    def __init__(self, metric_names=METRIC_NAMES, relative_accuracy=1e-3, max_buckets=2048,
+        histogram_ranges=None, num_bins=20):
+        self.metric_names = list(metric_names)
+        self.num_bins = num_bins
+        self.sketches = {name: QuantileSketch(relative_accuracy, max_buckets=max_buckets) for name in self.metric_names}
+        histogram_ranges = histogram_ranges or {}
+        self.histograms = {name: Histogram(*sorted(histogram_ranges[name]), num_bins=num_bins)
+            for name in self.metric_names if name in histogram_ranges}
+
+    def add(self, record):
+        """
+        Adds a metric record. Metrics missing from the record are skipped.
+        """
+        for name in self.metric_names:
+            value = record.get(name)
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                continue
+            self.sketches[name].add(value)
+            if name in self.histograms:
+                self.histograms[name].add(value)
+
+    def update(self, records):
+        for record in records:
+            self.add(record)
+        return self
+
+    def merge(self, other):
+        if self.metric_names != other.metric_names:
+            raise ValueError('Cannot merge aggregators with different metrics.')
+        for name in self.metric_names:
+            self.sketches[name].merge(other.sketches[name])
+            if name in self.histograms:
+                self.histograms[name].merge(other.histograms[name])
+        return self
+
+    def count(self, metric_name):
+        return self.sketches[metric_name].count
+
+    def quantile(self, metric_name, q):
+        return self.sketches[metric_name].quantile(q)
+
+    def percentile_rank(self, metric_name, value):
+        """
+        Returns the estimated fraction of the ensemble with
+        the given metric below the given value (e.g., of a query plan).
+        """
+        return self.sketches[metric_name].percentile_rank(value)
+
+    def outlier_score(self, metric_name, value):
+        """
+        Returns the estimated fraction of the ensemble that is
+        less extreme than the given value, i.e., |2 * rank - 1|.
+        A score near 1 means the value is more extreme than
+        almost all plans in the ensemble, on either side.
+        """
+        return abs(2 * self.percentile_rank(metric_name, value) - 1)
+
+    def histogram_df(self, metric_name):
+        """
+        Returns a DataFrame with 'bin_start', 'bin_end', and 'count' columns
+        for charting the distribution of the given metric.
+        The fixed-bin histogram is used if it exists, with an extra bin
+        on either side for values outside its range; otherwise
+        num_bins equal-width bins spanning the sketch's min and max are used,
+        so no values are left out.
+        """
+        sketch = self.sketches[metric_name]
+        if metric_name in self.histograms:
+            histogram = self.histograms[metric_name]
+            histogram_df = histogram.to_df()
+            if histogram.underflow:
+                histogram_df = pd.concat([pd.DataFrame({'bin_start': [sketch.min],
+                    'bin_end': [histogram.lower], 'count': [histogram.underflow]}), histogram_df])
+            if histogram.overflow:
+                histogram_df = pd.concat([histogram_df, pd.DataFrame({'bin_start': [histogram.upper],
+                    'bin_end': [sketch.max], 'count': [histogram.overflow]})])
+            return histogram_df.reset_index(drop=True)
+
+        if sketch.count == 0:
+            return pd.DataFrame(columns=['bin_start', 'bin_end', 'count'])
+
+        lower, upper = sketch.min, sketch.max
+        if lower == upper: # All values are equal; give the single bin some width
+            pad = max(abs(lower) * 1e-6, 1e-12)
+            lower, upper = lower - pad, upper + pad
+        binned = Histogram(lower, upper, self.num_bins)
+        for bucket_lower, bucket_upper, value, count in sketch.sorted_buckets():
+            binned.add(min(max(value, lower), upper), count)
+        return binned.to_df()
+
+    def to_dict(self):
+        return {
+            'metric_names': self.metric_names,
+            'num_bins': self.num_bins,
+            'sketches': {name: sketch.to_dict() for name, sketch in self.sketches.items()},
+            'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, aggregator_dict):
+        aggregator = cls(aggregator_dict['metric_names'], num_bins=aggregator_dict['num_bins'])
+        aggregator.sketches = {name: QuantileSketch.from_dict(sketch_dict)
+            for name, sketch_dict in aggregator_dict['sketches'].items()}
+        aggregator.histograms = {name: Histogram.from_dict(histogram_dict)
+            for name, histogram_dict in aggregator_dict['histograms'].items()}
+        return aggregator
+
+    def save(self, fname):
+        with open(fname, 'w') as outfile:
+            json.dump(self.to_dict(), outfile)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname, 'r') as infile:
+            return cls.from_dict(json.load(infile))
+
+
+def metric_ranges(records, metric_names=METRIC_NAMES):
+    """
+    Returns a dictionary mapping each metric name to the (min, max)
+    of its values in the given records, for the histogram_ranges
+    of an EnsembleAggregator. Ranges of a single value are widened
+    slightly so that they have positive width.
+    """
+    ranges = {}
+    for record in records:
+        for name in metric_names:
+            value = record.get(name)
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                continue
+            lower, upper = ranges.get(name, (value, value))
+            ranges[name] = (min(lower, value), max(upper, value))
+
+    for name, (lower, upper) in ranges.items():
+        if lower == upper:
+            pad = max(abs(lower) * 1e-6, 1e-12)
+            ranges[name] = (lower - pad, upper + pad)
+    return ranges
+
+
+# Record sources
+def read_metrics_records(fname='geojson/all_plan_metrics'):
+    """
+    Yields one metric record per plan from a column-oriented
+    metrics file such as 'geojson/all_plan_metrics'.
+    """
+    with open(fname, 'r') as infile:
+        columns = json.load(infile)
+
+    for key in columns['plan']:
+        yield {name: values[key] for name, values in columns.items()}
+
+
+def read_plan_records(plan_fnames):
+    """
+    Yields one metric record per plan GeoJSON file
+    (e.g., 'geojson/wi_map_plan_N.geojson'),
+    reading one file at a time.
+    """
+    for fname in plan_fnames:
+        plan = geopandas.read_file(fname)
+        yield {name: plan[name].iloc[0] for name in METRIC_NAMES}
+
+
+def partition_records(partitions):
+    """
+    Yields one metric record per gerrychain.Partition,
+    e.g., for each step of a gerrychain.MarkovChain.
+    """
+    for partition in partitions:
+        k = len(partition.parts)
+        gop_votes = [partition['gop_votes'][i] for i in range(1, k + 1)]
+        dem_votes = [partition['dem_votes'][i] for i in range(1, k + 1)]
+        yield {
+            'SL_index': helpers.SL_votes_helper(gop_votes, dem_votes),
+            # Using total population as a proxy for total_votes, as in `helpers.compute_efficiency_gap`
+            'efficiency_gap': helpers.EG_helper(gop_votes, dem_votes, partition.graph.data.population.sum()),
+            'mm_gap': helpers.MM_helper(gop_votes, dem_votes)
+        }
+
+
+if __name__ == "__main__":
+    tracts_fname = 'data/tl_2013_55_tract.zip'
+    dem_assignment_fname = 'data/wi_gerrymander_dem.csv'
+    gop_assignment_fname = 'data/wi_gerrymander_rep.csv'
+    population_fname = 'data/wi_tract_populations_census_2010.csv'
+    voteshares_fname = 'data/wi_voteshares.csv'
+
+    # Two "workers" each summarize half of the plans, then merge
+    records = list(read_metrics_records('geojson/all_plan_metrics'))
+    aggregator = EnsembleAggregator().update(records[::2])
+    aggregator.merge(EnsembleAggregator().update(records[1::2]))
+
+    for name in METRIC_NAMES:
+        print('{0}: median {1:.6f}, 5th-95th percentile [{2:.6f}, {3:.6f}]'.format(name,
+            aggregator.quantile(name, 0.5), aggregator.quantile(name, 0.05), aggregator.quantile(name, 0.95)))
+
+    dem_plan = helpers.build_district_plan(tracts_fname, dem_assignment_fname, population_fname, voteshares_fname)
+    gop_plan = helpers.build_district_plan(tracts_fname, gop_assignment_fname, population_fname, voteshares_fname)
+
+    for plan_name, record in zip(['Dem.', 'GOP'], partition_records([dem_plan, gop_plan])):
+        print('\n~~~ {0} plan percentile ranks ~~~'.format(plan_name))
+        for name in METRIC_NAMES:
+            print('\t{0}: {1:.4f} (rank {2:.2%}, outlier score {3:.4f})'.format(name, record[name],
+                aggregator.percentile_rank(name, record[name]), aggregator.outlier_score(name, record[name])))
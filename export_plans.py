@@ -0,0 +1,356 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely.ops
+
+import helpers
+
+######################################################################
+#
+# Batch exporter for per-plan map artifacts
+# (e.g., 'geojson/wi_map_plan_N.geojson' and 'geojson/all_plan_metrics')
+#
+# Plans come from a flip path (see `helpers.save_path_of_maps`) or
+# an assignment matrix (CSV with a 'GEOID' column and one column of
+# district indices per plan). Consecutive plans are grouped into
+# chunks that are materialized (join, dissolve, metrics, serialize)
+# in a process pool. Within a chunk, only the districts changed by
+# each flip are dissolved again.
+#
+# Each output is written to a temporary file and renamed into place,
+# and finished plans are recorded in a manifest, so an interrupted
+# run resumes where it stopped when rerun with the same arguments.
+#
+# Example:
+#   python export_plans.py data/wi_path_100flips.json --out-dir exported_plans --precision 6
+#
+######################################################################
+
+OUTPUT_FORMATS = {
+    'geojson': ('GeoJSON', '.geojson'),
+    'gpkg': ('GPKG', '.gpkg'),
+    'parquet': (None, '.parquet')
+}
+MANIFEST_FNAME = 'manifest.json'
+METRICS_FNAME = 'all_plan_metrics'
+TALLY_COLUMNS = ['population', 'gop_votes', 'dem_votes']
+METRIC_NAMES = ['SL_index', 'efficiency_gap', 'mm_gap']
+
+# Tract GeoDataFrame with population and voteshare data, loaded once per worker
+worker_tracts = None
+
+
+def read_assignment_matrix(fname):
+    """
+    Reads an assignment matrix CSV with a 'GEOID' column and
+    one column of district indices per plan,
+    and yields the assignment dictionary of each plan in column order.
+    """
+    matrix_df = pd.read_csv(fname, dtype={'GEOID': str}).set_index('GEOID')
+    for column in matrix_df.columns:
+        yield matrix_df[column].astype(int).to_dict()
+
+
+def read_assignments(fname):
+    """
+    Yields the assignment dictionary of each plan in the given
+    flip path (.json) or assignment matrix (.csv) file.
+    """
+    if fname.endswith('.json'):
+        return helpers.read_path_of_maps(fname)
+    return read_assignment_matrix(fname)
+
+
+def iter_chunks(assignments, chunk_size):
+    """
+    Groups consecutive assignments into chunks of at most chunk_size plans.
+
+    Yields tuples (first_plan_number, initial_assignment, diffs),
+    where diffs[i] maps the units that change between
+    plans first_plan_number + i and first_plan_number + i + 1
+    to their new districts.
+    """
+    first_plan_number = 1
+    initial_assignment = None
+    previous = None
+    diffs = []
+
+    for plan_number, assignment in enumerate(assignments, start=1):
+        if initial_assignment is None:
+            first_plan_number = plan_number
+            initial_assignment = assignment
+        else:
+            diffs.append({unit: district for unit, district in assignment.items() if previous.get(unit) != district})
+        previous = assignment
+
+        if len(diffs) + 1 == chunk_size:
+            yield first_plan_number, initial_assignment, diffs
+            initial_assignment = None
+            diffs = []
+
+    if initial_assignment is not None:
+        yield first_plan_number, initial_assignment, diffs
+
+
+def init_worker(tracts_fname, pop_fname, voteshares_fname):
+    """
+    Loads the tracts with population and voteshare data
+    into the worker process.
+    """
+    global worker_tracts
+    tracts_fname = tracts_fname if 'zip://' in tracts_fname else 'zip://' + tracts_fname
+    gdf = helpers.load_shapefile(tracts_fname)
+    gdf = helpers.add_population_data(gdf, pop_fname)
+    gdf = helpers.add_voteshare_data(gdf, voteshares_fname)
+    if 'gop_votes' not in gdf.columns: # No voteshare file given
+        gdf['gop_votes'] = gdf['gop_voteshare'] * gdf['population']
+        gdf['dem_votes'] = gdf['dem_voteshare'] * gdf['population']
+    worker_tracts = gdf
+
+
+def round_coordinates(geometry, precision):
+    """
+    Rounds the coordinates of the given geometry to
+    the given number of decimal places.
+    """
+    return shapely.ops.transform(lambda *coords: tuple(np.round(np.asarray(c), precision) for c in coords), geometry)
+
+
+def build_plan_gdf(districts, district_geometries):
+    """
+    Given a Series mapping each tract to its district (-1 if unassigned)
+    and a dictionary of dissolved district geometries,
+    returns a GeoDataFrame with one row per district with
+    tallies, voteshares, and plan metrics.
+
+    As in the committed 'geojson/wi_map_plan_N.geojson' files (which the
+    apps chart), district voteshares are sums of tract voteshares,
+    not vote ratios (which follow from gop_votes and dem_votes).
+    """
+    tallies = worker_tracts[TALLY_COLUMNS + ['gop_voteshare', 'dem_voteshare']].groupby(districts).sum().sort_index()
+
+    assigned = tallies[tallies.index != -1]
+    gop_votes = assigned['gop_votes'].tolist()
+    dem_votes = assigned['dem_votes'].tolist()
+    tallies['SL_index'] = helpers.SL_votes_helper(gop_votes, dem_votes)
+    # Using total population as a proxy for total_votes, as in `helpers.compute_efficiency_gap`
+    tallies['efficiency_gap'] = helpers.EG_helper(gop_votes, dem_votes, worker_tracts['population'].sum())
+    tallies['mm_gap'] = helpers.MM_helper(gop_votes, dem_votes)
+
+    tallies.index.name = 'district'
+    tallies = tallies.reset_index()
+    tallies = tallies[['district', 'population', 'gop_voteshare', 'dem_voteshare', 'gop_votes', 'dem_votes'] + METRIC_NAMES]
+    geometries = [district_geometries[district] for district in tallies['district']]
+    return gpd.GeoDataFrame(tallies, geometry=geometries, crs=worker_tracts.crs)
+
+
+def write_atomically(plan_gdf, fname, output_format):
+    """
+    Writes the given GeoDataFrame to a temporary file
+    next to fname and renames it into place,
+    so that fname is either absent or complete.
+    """
+    driver, extension = OUTPUT_FORMATS[output_format]
+    tmp_fname = os.path.join(os.path.dirname(fname), '.tmp-' + os.path.basename(fname))
+    if os.path.exists(tmp_fname):
+        os.remove(tmp_fname) # Left over from an interrupted run
+
+    if driver is None:
+        plan_gdf.to_parquet(tmp_fname)
+    elif driver == 'GPKG':
+        # The layer name would otherwise come from the temporary file name
+        plan_gdf.to_file(tmp_fname, driver=driver, layer=os.path.basename(fname)[:-len(extension)])
+    else:
+        plan_gdf.to_file(tmp_fname, driver=driver)
+
+    with open(tmp_fname, 'rb') as tmp_file:
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_fname, fname)
+
+
+def export_chunk(first_plan_number, assignment, diffs, plan_numbers, out_dir, prefix, output_format, precision):
+    """
+    Materializes and writes each plan of the given chunk
+    whose number is in plan_numbers (plans already exported are skipped,
+    but their flips are still applied).
+
+    Returns a dictionary mapping each written plan number to
+    its manifest entry (file name and plan metrics).
+    """
+    extension = OUTPUT_FORMATS[output_format][1]
+    geometries = worker_tracts.geometry
+    districts = pd.Series(assignment).reindex(worker_tracts.index).fillna(-1).astype(int)
+    district_geometries = {}
+    changed = set(districts.unique())
+    entries = {}
+
+    for offset in range(len(diffs) + 1):
+        if offset > 0:
+            diff = pd.Series(diffs[offset - 1], dtype=int)
+            diff = diff[diff.index.isin(districts.index)]
+            changed |= set(districts[diff.index]) | set(diff)
+            districts[diff.index] = diff
+
+        plan_number = first_plan_number + offset
+        if plan_number not in plan_numbers:
+            # Changed districts are only dissolved again for plans that are written
+            continue
+
+        for district in changed:
+            district_geometry = geometries[districts == district].unary_union
+            if precision is not None:
+                district_geometry = round_coordinates(district_geometry, precision)
+            district_geometries[district] = district_geometry
+        changed = set()
+
+        plan_gdf = build_plan_gdf(districts, district_geometries)
+        fname = '{0}{1}{2}'.format(prefix, plan_number, extension)
+        write_atomically(plan_gdf, os.path.join(out_dir, fname), output_format)
+
+        entry = {'file': fname}
+        entry.update({name: float(plan_gdf[name].iloc[0]) for name in METRIC_NAMES})
+        entries[plan_number] = entry
+
+    return entries
+
+
+def save_json_atomically(data, fname):
+    tmp_fname = os.path.join(os.path.dirname(fname), '.tmp-' + os.path.basename(fname))
+    with open(tmp_fname, 'w') as outfile:
+        json.dump(data, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp_fname, fname)
+
+
+def input_fingerprint(fname):
+    """
+    Returns the absolute path, modification time, and size of
+    the given input file (None if no file is given),
+    so that a run with changed inputs does not resume a previous one.
+    """
+    if fname is None:
+        return None
+    path = os.path.abspath(fname.replace('zip://', ''))
+    stat = os.stat(path)
+    return {'path': path, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def load_manifest(out_dir, settings):
+    """
+    Loads the manifest of a previous run into out_dir.
+    Plans from a run with different settings, or whose files are missing,
+    are not counted as done.
+    """
+    manifest = {'settings': settings, 'plans': {}}
+    manifest_fname = os.path.join(out_dir, MANIFEST_FNAME)
+    if not os.path.exists(manifest_fname):
+        return manifest
+
+    with open(manifest_fname, 'r') as infile:
+        previous = json.load(infile)
+    if previous.get('settings') != settings:
+        print('Settings differ from the previous run in {0}; exporting all plans.'.format(out_dir))
+        return manifest
+
+    for key, entry in previous['plans'].items():
+        if os.path.exists(os.path.join(out_dir, entry['file'])):
+            manifest['plans'][key] = entry
+    return manifest
+
+
+def save_metrics(manifest, out_dir):
+    """
+    Saves the metrics of all exported plans in the same
+    column-oriented format as 'geojson/all_plan_metrics'.
+    """
+    keys = sorted(manifest['plans'], key=int)
+    metrics = {'plan': {key: int(key) for key in keys}}
+    for name in METRIC_NAMES:
+        metrics[name] = {key: manifest['plans'][key][name] for key in keys}
+    save_json_atomically(metrics, os.path.join(out_dir, METRICS_FNAME))
+
+
+def export_plans(plans_fname, out_dir, tracts_fname, pop_fname=None, voteshares_fname=None,
+    prefix='wi_map_plan_', output_format='geojson', precision=None, workers=None, chunk_size=25):
+    """
+    Exports every plan of the given flip path or assignment matrix
+    to out_dir using a pool of worker processes (see module comment).
+
+    Returns the manifest dictionary.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('output_format must be one of {0}, but is {1}.'.format(list(OUTPUT_FORMATS), output_format))
+    os.makedirs(out_dir, exist_ok=True)
+    workers = workers or os.cpu_count()
+
+    settings = {
+        'plans': input_fingerprint(plans_fname),
+        'tracts': input_fingerprint(tracts_fname),
+        'populations': input_fingerprint(pop_fname),
+        'voteshares': input_fingerprint(voteshares_fname),
+        'prefix': prefix,
+        'format': output_format,
+        'precision': precision
+    }
+    manifest = load_manifest(out_dir, settings)
+    manifest_fname = os.path.join(out_dir, MANIFEST_FNAME)
+    chunks = iter_chunks(read_assignments(plans_fname), chunk_size)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+        initargs=(tracts_fname, pop_fname, voteshares_fname)) as executor:
+        pending = set()
+        exhausted = False
+
+        while pending or not exhausted:
+            # Keep a bounded number of chunks in flight so that
+            # assignments are not all held in memory at once
+            while not exhausted and len(pending) < 2 * workers:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                    break
+                first_plan_number, assignment, diffs = chunk
+                plan_numbers = {first_plan_number + offset for offset in range(len(diffs) + 1)
+                    if str(first_plan_number + offset) not in manifest['plans']}
+                if plan_numbers:
+                    pending.add(executor.submit(export_chunk, first_plan_number, assignment, diffs,
+                        plan_numbers, out_dir, prefix, output_format, precision))
+
+            if not pending:
+                continue
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for plan_number, entry in future.result().items():
+                    manifest['plans'][str(plan_number)] = entry
+            save_json_atomically(manifest, manifest_fname)
+            print('Exported {0} plans'.format(len(manifest['plans'])))
+
+    save_json_atomically(manifest, manifest_fname)
+    save_metrics(manifest, out_dir)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export per-plan map files and metrics for a path of district plans.')
+    parser.add_argument('plans', help='flip path (.json) or assignment matrix (.csv)')
+    parser.add_argument('--out-dir', default='exported_plans',
+        help='output directory (pass geojson to replace the files the apps read)')
+    parser.add_argument('--tracts', default='data/tl_2013_55_tract.zip', help='census tracts file (zipped shapefile)')
+    parser.add_argument('--populations', default='data/wi_tract_populations_census_2010.csv')
+    parser.add_argument('--voteshares', default='data/wi_voteshares.csv')
+    parser.add_argument('--prefix', default='wi_map_plan_', help='output file name prefix')
+    parser.add_argument('--format', default='geojson', choices=sorted(OUTPUT_FORMATS))
+    parser.add_argument('--precision', type=int, default=None, help='number of decimal places kept in coordinates')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--chunk-size', type=int, default=25, help='number of consecutive plans per task')
+    args = parser.parse_args()
+
+    export_plans(args.plans, args.out_dir, args.tracts, args.populations, args.voteshares,
+        prefix=args.prefix, output_format=args.format, precision=args.precision,
+        workers=args.workers, chunk_size=args.chunk_size)
@@ -9,6 +9,7 @@ import os
 import pandas as pd
 import random
 
+import compactness
 import gerrychain
 from gerrychain.accept import always_accept
 from gerrychain.proposals import propose_random_flip
@@ -82,7 +83,7 @@ def add_voteshare_data(gdf, voteshares_file_path=None):
     return gdf
 
 
-def build_partition(gdf, assignment_file_path=None, assignment_dict=None):
+def build_partition(gdf, assignment_file_path=None, assignment_dict=None, boundary_data=None):
     """
     Loads a CSV representing a district plan as 
     a mapping of 'GEOID' to 'district', 
@@ -92,6 +93,9 @@ def build_partition(gdf, assignment_file_path=None, assignment_dict=None):
     Creates a gerrychain.Partition object using
     the graph of the given GeoDataFrame and 
     the assignment mapping. 
+
+    If boundary_data (see `compactness.compute_boundary_data`) is given, 
+    then the partition also has 'polsby_popper' and 'reock' updaters. 
     """
     if assignment_file_path is not None:
         with open(assignment_file_path, 'r') as file:
@@ -134,11 +138,17 @@ def build_partition(gdf, assignment_file_path=None, assignment_dict=None):
     if 'dem_votes' not in gdf.columns:
         gdf['dem_votes'] = 0
 
-    return gerrychain.Partition(graph, assignment, updaters={
+    updaters = {
         'population': gerrychain.updaters.Tally('population'), 
         'gop_votes': gerrychain.updaters.Tally('gop_votes'),
         'dem_votes': gerrychain.updaters.Tally('dem_votes')
-        }) # The updater {'cut_edges': cut_edges} is included by default
+        } # The updater {'cut_edges': cut_edges} is included by default
+
+    if boundary_data is not None:
+        compactness.add_boundary_data(graph, boundary_data)
+        updaters.update(compactness.compactness_updaters())
+
+    return gerrychain.Partition(graph, assignment, updaters=updaters)
 
 
 def build_grid_graph(rows, cols):
@@ -251,7 +261,7 @@ def load_shapefile(shapefile_path):
     return gdf.set_index('GEOID')
 
 
-def build_district_plan(tracts_fname, assignment_fname, pop_fname=None, voteshares_fname=None):
+def build_district_plan(tracts_fname, assignment_fname, pop_fname=None, voteshares_fname=None, boundary_fname=None):
     """
     Loads a sample Wisconsin district plan. 
 
@@ -260,6 +270,8 @@ def build_district_plan(tracts_fname, assignment_fname, pop_fname=None, voteshar
         partition_fname: the name of the initial partition file (.csv)
         pop_fname: (optional) the name of the population data file (.csv)
         voteshares_fname: (optional) the name of the voteshares data file (.csv)
+        boundary_fname: (optional) the name of the precomputed boundary data file (.json), 
+            see `compactness.save_boundary_data`
 
     Returns:
         the given Wisconsin district plan as a GerryChain Partition object
@@ -268,7 +280,8 @@ def build_district_plan(tracts_fname, assignment_fname, pop_fname=None, voteshar
     gdf = load_shapefile(tracts_fname)
     gdf = add_population_data(gdf, pop_fname)
     gdf = add_voteshare_data(gdf, voteshares_fname)
-    plan = build_partition(gdf, assignment_fname)
+    boundary_data = None if boundary_fname is None else compactness.load_boundary_data(boundary_fname)
+    plan = build_partition(gdf, assignment_fname, boundary_data=boundary_data)
     return plan
 
 
@@ -296,6 +309,33 @@ def save_path_of_maps(path, fname='path_out.json'):
         json.dump(path_dict, outfile)
 
 
+def read_path_of_maps(fname):
+    """
+    Reads a path of district maps saved by `save_path_of_maps` 
+    and yields the assignment dictionary (GEOID to district index) 
+    of each map along the path, starting with the initial map. 
+
+    The i-th yielded map (1-indexed) is the initial map 
+    after the first i - 1 flips have been applied, 
+    so the maps of 'data/wi_path_100flips.json' line up with 
+    the plan numbers of 'geojson/wi_map_plan_N.geojson'. 
+    """
+    with open(fname, 'r') as infile:
+        path_dict = json.load(infile)
+
+    assignment = {}
+    for key, units in path_dict['initial_map'].items():
+        for unit in units:
+            assignment[unit] = int(key)
+
+    yield dict(assignment)
+
+    for flip in path_dict['flips']:
+        for unit, district in flip.items():
+            assignment[unit] = int(district)
+        yield dict(assignment)
+
+
 def compute_feasible_flows(partition):
     """
     Given a Partition object, 
@@ -413,13 +453,26 @@ def compute_SL_index(partition):
     Disproportionality and Electoral Systems." 1991.
     """
     k = len(partition.parts)
-    gop_vote_shares = [partition['gop_votes'][i] / (partition['gop_votes'][i] + partition['dem_votes'][i]) for i in range(1, k + 1)]
+    gop_votes = [partition['gop_votes'][i] for i in range(1, k + 1)]
+    dem_votes = [partition['dem_votes'][i] for i in range(1, k + 1)]
+    gop_vote_shares = [gop_votes[i] / (gop_votes[i] + dem_votes[i]) for i in range(k)]
     print('\tGOP vote shares:', np.round(gop_vote_shares, decimals=4))
+    return SL_votes_helper(gop_votes, dem_votes)
+
+
+def SL_votes_helper(gop_votes, dem_votes):
+    """
+    Computes the Sainte-Laguë Index given 
+    the GOP and Democratic votes in each district 
+    (lists of the same length). 
+    """
+    k = len(gop_votes)
+    gop_vote_shares = [gop_votes[i] / (gop_votes[i] + dem_votes[i]) for i in range(k)]
     gop_seat_share = sum((v >= 0.5) for v in gop_vote_shares) / k
     dem_seat_share = 1 - gop_seat_share
     
-    gop_total_votes = sum(partition['gop_votes'][i] for i in range(1, k + 1))
-    dem_total_votes = sum(partition['dem_votes'][i] for i in range(1, k + 1))
+    gop_total_votes = sum(gop_votes)
+    dem_total_votes = sum(dem_votes)
     gop_vote_share = gop_total_votes / (gop_total_votes + dem_total_votes)
     dem_vote_share = 1 - gop_vote_share
     
@@ -463,21 +516,31 @@ def compute_efficiency_gap(partition):
     "Partisan gerrymandering and the efficiency gap." 2015.
     """
     k = len(partition.parts)
+    gop_votes = [partition['gop_votes'][i] for i in range(1, k + 1)]
+    dem_votes = [partition['dem_votes'][i] for i in range(1, k + 1)]
+
+    # Using total population as a proxy for total_votes for simplicity
+    total_votes = partition.graph.data.population.sum()
+    return EG_helper(gop_votes, dem_votes, total_votes)
+
+
+def EG_helper(gop_votes, dem_votes, total_votes):
+    """
+    Computes the efficiency gap (GOP perspective) given 
+    the GOP and Democratic votes in each district 
+    (lists of the same length) and the total votes. 
+    """
     gop_wasted_votes = 0
     dem_wasted_votes = 0
 
-    for i in range(1, k + 1):
-        gop_votes = partition['gop_votes'][i]
-        dem_votes = partition['dem_votes'][i]
-        if gop_votes > dem_votes:
-            gop_wasted_votes += gop_votes - 0.5 * (gop_votes + dem_votes)
-            dem_wasted_votes += dem_votes
+    for gop_district_votes, dem_district_votes in zip(gop_votes, dem_votes):
+        if gop_district_votes > dem_district_votes:
+            gop_wasted_votes += gop_district_votes - 0.5 * (gop_district_votes + dem_district_votes)
+            dem_wasted_votes += dem_district_votes
         else:
-            gop_wasted_votes += gop_votes
-            dem_wasted_votes += dem_votes - 0.5 * (gop_votes + dem_votes)
+            gop_wasted_votes += gop_district_votes
+            dem_wasted_votes += dem_district_votes - 0.5 * (gop_district_votes + dem_district_votes)
 
-    # Using total population as a proxy for total_votes for simplicity
-    total_votes = partition.graph.data.population.sum()
     return (gop_wasted_votes - dem_wasted_votes) / total_votes
 
 
@@ -498,7 +561,18 @@ def compute_mm_gap(partition):
     "Implementing partisan symmetry: Problems and paradoxes." 2020. 
     """
     k = len(partition.parts)
-    gop_vote_shares = [partition['gop_votes'][i] / (partition['gop_votes'][i] + partition['dem_votes'][i]) for i in range(1, k + 1)]
+    gop_votes = [partition['gop_votes'][i] for i in range(1, k + 1)]
+    dem_votes = [partition['dem_votes'][i] for i in range(1, k + 1)]
+    return MM_helper(gop_votes, dem_votes)
+
+
+def MM_helper(gop_votes, dem_votes):
+    """
+    Computes the mean-median gap (GOP perspective) given 
+    the GOP and Democratic votes in each district 
+    (lists of the same length). 
+    """
+    gop_vote_shares = [gop / (gop + dem) for gop, dem in zip(gop_votes, dem_votes)]
     return np.mean(gop_vote_shares) - np.median(gop_vote_shares)
 
 
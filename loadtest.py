@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import math
+import random
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+######################################################################
+#
+# Load-test harness for plan_server.py
+#
+# Starts a local plan server (unless --url is given), then for each
+# concurrency level opens that many keep-alive connections, each
+# sending requests back to back, and reports throughput and
+# p50/p99 latency. Latency percentiles are over successful
+# (2xx and 304) responses only, since rejected requests (e.g., 503
+# when the worker pool is saturated) return quickly and would
+# otherwise make an overloaded server look faster.
+#
+# Example:
+#   python loadtest.py --concurrency 1 4 16 64 --requests 2000
+#
+######################################################################
+
+DEFAULT_PATHS = ['/metrics', '/plans', '/plans/{plan}', '/plans/{plan}/metrics', '/plans/{plan}/tallies']
+
+
+def percentile(sorted_values, q):
+    """
+    Returns the q-th percentile (0 <= q <= 100) of the given sorted values
+    using the nearest-rank method.
+    """
+    if not sorted_values:
+        return float('nan')
+    rank = max(1, math.ceil(q * len(sorted_values) / 100))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def is_success(status):
+    return 200 <= status < 300 or status == 304
+
+
+async def read_response(reader):
+    """
+    Reads one HTTP response and returns (status, headers, body).
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('Connection closed by server')
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, headers, body
+
+
+async def client(host, port, paths, num_requests, latencies, statuses, revalidate, rng):
+    """
+    Sends num_requests requests for random paths over one
+    keep-alive connection, recording statuses and
+    the latencies (in seconds) of successful responses.
+    If revalidate is True, repeated paths are requested with
+    If-None-Match, as a browser with a warm cache would.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    etags = {}
+    try:
+        for i in range(num_requests):
+            path = rng.choice(paths)
+            request = 'GET {0} HTTP/1.1\r\nHost: {1}:{2}\r\n'.format(path, host, port)
+            if revalidate and path in etags:
+                request += 'If-None-Match: {0}\r\n'.format(etags[path])
+            start = time.perf_counter()
+            writer.write((request + '\r\n').encode('latin-1'))
+            await writer.drain()
+            status, headers, body = await read_response(reader)
+            latency = time.perf_counter() - start
+            if is_success(status):
+                latencies.append(latency)
+            statuses[status] = statuses.get(status, 0) + 1
+            if 'etag' in headers:
+                etags[path] = headers['etag']
+            if headers.get('connection') == 'close':
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+    finally:
+        writer.close()
+
+
+async def warm_up(host, port, paths):
+    """
+    Requests each path once over one keep-alive connection.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for path in paths:
+            writer.write('GET {0} HTTP/1.1\r\nHost: {1}:{2}\r\n\r\n'.format(path, host, port).encode('latin-1'))
+            await writer.drain()
+            status, headers, body = await read_response(reader)
+            if headers.get('connection') == 'close':
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+    finally:
+        writer.close()
+
+
+async def run_level(host, port, paths, concurrency, num_requests, revalidate, seed):
+    latencies = []
+    statuses = {}
+    per_client = [num_requests // concurrency + (i < num_requests % concurrency) for i in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, paths, n, latencies, statuses, revalidate, random.Random(seed + i))
+        for i, n in enumerate(per_client)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': sum(statuses.values()),
+        'successes': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': 1000 * percentile(latencies, 50),
+        'p99_ms': 1000 * percentile(latencies, 99),
+        'statuses': statuses
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_local_server(port, server_args, timeout=60):
+    """
+    Starts plan_server.py on the given port and waits until it accepts connections.
+    """
+    process = subprocess.Popen([sys.executable, 'plan_server.py', '--port', str(port)] + server_args)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('plan_server.py exited with code {0}'.format(process.returncode))
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('plan_server.py did not start within {0} seconds'.format(timeout))
+
+
+async def main(args):
+    if args.url is None:
+        host, port = '127.0.0.1', free_port()
+        process = start_local_server(port, args.server_args)
+    else:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+        process = None
+
+    paths = [path.format(plan=plan) for path in args.paths for plan in range(1, args.num_plans + 1)]
+    paths = list(dict.fromkeys(paths)) # Paths without {plan} appear once
+
+    try:
+        # Warm up so the first level does not measure cold caches and worker start-up
+        await warm_up(host, port, paths)
+
+        # req/s and latencies are over successful responses
+        print('{0:>11} {1:>9} {2:>9} {3:>12} {4:>9} {5:>9}  statuses'.format(
+            'concurrency', 'requests', 'ok', 'ok req/s', 'p50 ms', 'p99 ms'))
+        for concurrency in args.concurrency:
+            result = await run_level(host, port, paths, concurrency, args.requests, args.revalidate, args.seed)
+            print('{concurrency:>11} {requests:>9} {successes:>9} {throughput:>12.1f} {p50_ms:>9.2f} {p99_ms:>9.2f}  {statuses}'.format(**result))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure plan_server.py latency at increasing concurrency.')
+    parser.add_argument('--url', default=None, help='base URL of a running server (default: start a local one)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument('--requests', type=int, default=1000, help='number of requests per concurrency level')
+    parser.add_argument('--paths', nargs='+', default=DEFAULT_PATHS, help='request paths; {plan} is replaced by plan numbers')
+    parser.add_argument('--num-plans', type=int, default=83)
+    parser.add_argument('--revalidate', action='store_true', help='send If-None-Match for repeated paths')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--server-args', nargs=argparse.REMAINDER, default=[], help='arguments passed to plan_server.py')
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,458 @@
+import argparse
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import email.utils
+import hashlib
+import json
+import os
+import re
+
+import pandas as pd
+
+import chunked_pipeline
+
+######################################################################
+#
+# Lightweight asyncio HTTP service for district plans and metrics
+#
+# Routes (GET and HEAD):
+#   /metrics                  all plan metrics ('all_plan_metrics')
+#   /plans                    list of plans with their metrics
+#   /plans/N                  GeoJSON map of plan N
+#   /plans/N/assignment       GEOID to district mapping of plan N
+#   /plans/N/tallies          population and votes of each district of plan N
+#   /plans/N/metrics          SL index, efficiency gap, and mean-median gap of plan N
+#
+# Every response has an ETag and Last-Modified header and honors
+# If-None-Match / If-Modified-Since (304) and single byte ranges (206),
+# so browsers and proxies can cache aggressively. Computed responses
+# are produced by a bounded process pool and kept in an LRU cache.
+#
+# Example:
+#   python plan_server.py --port 8000 --workers 4
+#
+######################################################################
+
+DEFAULT_PLANS_DIR = 'geojson'
+DEFAULT_PATH_FNAME = 'data/wi_path_100flips.json'
+DEFAULT_POP_FNAME = 'data/wi_tract_populations_census_2010.csv'
+DEFAULT_VOTESHARES_FNAME = 'data/wi_voteshares.csv'
+PLAN_FNAME = 'wi_map_plan_{}.geojson'
+METRICS_FNAME = 'all_plan_metrics'
+CHECKPOINT_INTERVAL = 100 # Plans between stored assignments when replaying flips
+
+STATUS_REASONS = {200: 'OK', 206: 'Partial Content', 304: 'Not Modified', 400: 'Bad Request',
+    404: 'Not Found', 405: 'Method Not Allowed', 416: 'Range Not Satisfiable',
+    500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+# Per-worker plan data, loaded once by `init_worker`
+worker_state = None
+
+
+# CPU-bound work, run in the process pool
+def init_worker(path_fname, pop_fname, voteshares_fname):
+    """
+    Loads the flip path and the tract population and voteshare data
+    into the worker process.
+    """
+    global worker_state
+    with open(path_fname, 'r') as infile:
+        path_dict = json.load(infile)
+
+    assignment = {}
+    for key, units in path_dict['initial_map'].items():
+        for unit in units:
+            assignment[unit] = int(key)
+    flips = [{unit: int(district) for unit, district in flip.items()} for flip in path_dict['flips']]
+
+    units = pd.read_csv(pop_fname, usecols=['GEOID', 'population'], dtype={'GEOID': str}).set_index('GEOID')
+    voteshares = pd.read_csv(voteshares_fname, usecols=['GEOID', 'gop_voteshare', 'dem_voteshare'],
+        dtype={'GEOID': str}).set_index('GEOID')
+    units = units.join(voteshares)
+    units['gop_votes'] = units['gop_voteshare'] * units['population']
+    units['dem_votes'] = units['dem_voteshare'] * units['population']
+
+    worker_state = {'checkpoints': {1: assignment}, 'flips': flips, 'units': units}
+
+
+def plan_assignment(plan_number):
+    """
+    Returns the assignment dictionary of the given plan
+    (the initial map after plan_number - 1 flips),
+    replaying flips from the nearest stored checkpoint.
+    """
+    if not 1 <= plan_number <= len(worker_state['flips']) + 1:
+        raise PlanNotFound(plan_number)
+
+    checkpoints = worker_state['checkpoints']
+    start = max(number for number in checkpoints if number <= plan_number)
+    assignment = dict(checkpoints[start])
+    for number in range(start + 1, plan_number + 1):
+        assignment.update(worker_state['flips'][number - 2])
+        if number % CHECKPOINT_INTERVAL == 0:
+            checkpoints[number] = dict(assignment)
+    return assignment
+
+
+def plan_tallies(plan_number):
+    """
+    Returns a tuple (tallies, total_population) for the given plan,
+    where tallies is a DataFrame indexed by district
+    (-1 for units not in the plan) as in `chunked_pipeline.accumulate_tallies`.
+    """
+    units = worker_state['units']
+    districts = pd.Series(plan_assignment(plan_number)).reindex(units.index).fillna(-1).astype(int)
+    tallies = units.groupby(districts)[chunked_pipeline.TALLY_COLUMNS].sum().sort_index()
+    tallies.index.name = 'district'
+    return tallies, units['population'].sum()
+
+
+def encode_json(data):
+    return json.dumps(data).encode('utf-8')
+
+
+def assignment_body(plan_number):
+    return encode_json(plan_assignment(plan_number))
+
+
+def tallies_body(plan_number):
+    tallies, total_population = plan_tallies(plan_number)
+    return encode_json({str(district): row for district, row in tallies.to_dict(orient='index').items()})
+
+
+def metrics_body(plan_number):
+    tallies, total_population = plan_tallies(plan_number)
+    metrics = chunked_pipeline.compute_plan_metrics(tallies, total_population)
+    return encode_json({name: float(value) for name, value in metrics.items()})
+
+
+def plans_body(metrics_fname):
+    with open(metrics_fname, 'r') as infile:
+        columns = json.load(infile)
+    plans = [{name: values[key] for name, values in columns.items()} for key in columns['plan']]
+    return encode_json(plans)
+
+
+# HTTP caching helpers
+def make_etag(body):
+    return '"{0}"'.format(hashlib.sha1(body).hexdigest()[:20])
+
+
+def is_not_modified(headers, etag, last_modified):
+    """
+    Returns True if the conditional request headers show that
+    the client's cached copy is current.
+    """
+    if 'if-none-match' in headers:
+        tags = [tag.strip() for tag in headers['if-none-match'].split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+    if 'if-modified-since' in headers:
+        try:
+            since = email.utils.parsedate_to_datetime(headers['if-modified-since']).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(last_modified) <= since
+    return False
+
+
+def parse_range(range_header, length):
+    """
+    Parses a single byte range 'bytes=start-end', 'bytes=start-',
+    or 'bytes=-suffix' for a body of the given length.
+
+    Returns (start, end) inclusive, None if the header should be ignored
+    (malformed or multiple ranges), or False if it is unsatisfiable.
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+    if match is None or match.group(1) == match.group(2) == '':
+        return None
+
+    if match.group(1) == '':
+        suffix = int(match.group(2))
+        if suffix == 0:
+            return False
+        return (max(0, length - suffix), length - 1)
+
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else length - 1
+    if start >= length or end < start:
+        return False
+    return (start, min(end, length - 1))
+
+
+class LRUCache:
+    """
+    Least-recently-used cache of response bodies,
+    bounded by the total number of bytes stored.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        body = value[0]
+        if len(body) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.num_bytes -= len(self.entries.pop(key)[0])
+        self.entries[key] = value
+        self.num_bytes += len(body)
+        while self.num_bytes > self.max_bytes:
+            old_key, old_value = self.entries.popitem(last=False)
+            self.num_bytes -= len(old_value[0])
+
+
+class PlanServer:
+    """
+    Serves plan data over HTTP/1.1 with keep-alive (see module comment).
+
+    CPU-bound work runs in a pool of `workers` processes;
+    at most `max_pending` such jobs are queued at once, and
+    further requests needing new work get a 503 response.
+    """
+
+    def __init__(self, plans_dir=DEFAULT_PLANS_DIR, path_fname=DEFAULT_PATH_FNAME,
+        pop_fname=DEFAULT_POP_FNAME, voteshares_fname=DEFAULT_VOTESHARES_FNAME,
+        workers=None, max_pending=64, cache_mb=256, max_age=3600):
+        self.plans_dir = plans_dir
+        self.path_fname = path_fname
+        self.pop_fname = pop_fname
+        self.voteshares_fname = voteshares_fname
+        self.metrics_fname = os.path.join(plans_dir, METRICS_FNAME)
+        self.max_age = max_age
+        self.cache = LRUCache(cache_mb * 2 ** 20)
+        self.in_flight = {} # Cache key to future, so concurrent identical requests share work
+        self.pending = asyncio.Semaphore(max_pending)
+        self.workers = workers
+        self.executor = self.make_executor()
+
+        plan_routes = [
+            (r'/plans/(\d+)', self.plan_map),
+            (r'/plans/(\d+)/assignment', self.computed(assignment_body, [path_fname])),
+            (r'/plans/(\d+)/tallies', self.computed(tallies_body, [path_fname, pop_fname, voteshares_fname])),
+            (r'/plans/(\d+)/metrics', self.computed(metrics_body, [path_fname, pop_fname, voteshares_fname]))
+        ]
+        self.routes = [(re.compile(pattern), handler) for pattern, handler in plan_routes]
+        self.routes.append((re.compile(r'/metrics'), self.metrics_file))
+        self.routes.append((re.compile(r'/plans'), self.plans_list))
+
+    # Handlers return (status, body, headers) or
+    # (body, etag, last_modified, content_type) for cacheable resources
+    async def plan_map(self, plan_number):
+        return await self.static_file(os.path.join(self.plans_dir, PLAN_FNAME.format(int(plan_number))),
+            'application/geo+json')
+
+    async def metrics_file(self):
+        return await self.static_file(self.metrics_fname, 'application/json')
+
+    async def plans_list(self):
+        try:
+            last_modified = os.path.getmtime(self.metrics_fname)
+        except FileNotFoundError:
+            return None
+        return await self.cached(('plans', last_modified), lambda: self.run_in_thread(plans_body, self.metrics_fname),
+            last_modified, 'application/json')
+
+    def computed(self, body_fn, source_fnames):
+        async def handler(plan_number):
+            last_modified = max(os.path.getmtime(fname) for fname in source_fnames)
+            key = (body_fn.__name__, int(plan_number), last_modified)
+            return await self.cached(key, lambda: self.run_in_pool(body_fn, int(plan_number)),
+                last_modified, 'application/json')
+        return handler
+
+    async def static_file(self, fname, content_type):
+        try:
+            stat = os.stat(fname)
+        except FileNotFoundError:
+            return None
+        key = ('file', fname, stat.st_mtime_ns, stat.st_size)
+        return await self.cached(key, lambda: self.run_in_thread(read_file, fname), stat.st_mtime, content_type)
+
+    async def cached(self, key, make_body, last_modified, content_type):
+        entry = self.cache.get(key)
+        if entry is None:
+            if key not in self.in_flight:
+                self.in_flight[key] = asyncio.ensure_future(make_body())
+            future = self.in_flight[key]
+            try:
+                body = await asyncio.shield(future)
+            finally:
+                if future.done():
+                    self.in_flight.pop(key, None)
+            entry = (body, make_etag(body))
+            self.cache.put(key, entry)
+        body, etag = entry
+        return body, etag, last_modified, content_type
+
+    def make_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+            initargs=(self.path_fname, self.pop_fname, self.voteshares_fname))
+
+    async def run_in_pool(self, fn, *args):
+        if self.pending.locked():
+            raise ServerBusy()
+        async with self.pending:
+            executor = self.executor
+            try:
+                return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+            except BrokenProcessPool as error:
+                # A worker died, which breaks the whole pool; replace it
+                # (once, if several requests fail together) and ask the client to retry
+                if self.executor is executor:
+                    print('Restarting worker pool: {0!r}'.format(error))
+                    self.executor = self.make_executor()
+                    executor.shutdown(wait=False)
+                raise ServerBusy() from error
+
+    async def run_in_thread(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    # HTTP/1.1
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    await self.respond(writer, 400, b'', {}, False)
+                    break
+                method, target, version = parts
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                status, body, response_headers = await self.dispatch(method, target.split('?', 1)[0], headers)
+                await self.respond(writer, status, body if method != 'HEAD' else b'', response_headers, keep_alive,
+                    content_length=len(body))
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, headers):
+        if method not in ('GET', 'HEAD'):
+            return 405, b'', {'Allow': 'GET, HEAD'}
+
+        for pattern, handler in self.routes:
+            match = pattern.fullmatch(path.rstrip('/') or '/')
+            if match is None:
+                continue
+            try:
+                result = await handler(*match.groups())
+            except PlanNotFound:
+                result = None
+            except ServerBusy:
+                return 503, b'', {'Retry-After': '1'}
+            except Exception as error:
+                print('Error serving {0}: {1!r}'.format(path, error))
+                return 500, b'', {}
+            if result is None:
+                break
+            return self.cacheable_response(headers, *result)
+
+        return 404, b'', {}
+
+    def cacheable_response(self, headers, body, etag, last_modified, content_type):
+        response_headers = {
+            'ETag': etag,
+            'Last-Modified': email.utils.formatdate(last_modified, usegmt=True),
+            'Cache-Control': 'public, max-age={0}'.format(self.max_age),
+            'Accept-Ranges': 'bytes',
+            'Content-Type': content_type
+        }
+        if is_not_modified(headers, etag, last_modified):
+            return 304, b'', response_headers
+
+        if 'range' in headers and headers.get('if-range', etag) in (etag, response_headers['Last-Modified']):
+            byte_range = parse_range(headers['range'], len(body))
+            if byte_range is False:
+                response_headers['Content-Range'] = 'bytes */{0}'.format(len(body))
+                return 416, b'', response_headers
+            if byte_range is not None:
+                start, end = byte_range
+                response_headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, len(body))
+                return 206, body[start:end + 1], response_headers
+
+        return 200, body, response_headers
+
+    async def respond(self, writer, status, body, headers, keep_alive, content_length=None):
+        lines = ['HTTP/1.1 {0} {1}'.format(status, STATUS_REASONS[status])]
+        headers = dict(headers)
+        if status != 304:
+            headers['Content-Length'] = str(len(body) if content_length is None else content_length)
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        lines.extend('{0}: {1}'.format(name, value) for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print('Serving plans on http://{0}:{1}'.format(host, port), flush=True)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class ServerBusy(Exception):
+    """Raised when the worker pool's queue is full."""
+
+
+class PlanNotFound(Exception):
+    """Raised when a plan number is outside the path of maps."""
+
+
+def read_file(fname):
+    with open(fname, 'rb') as infile:
+        return infile.read()
+
+
+async def main(args):
+    server = PlanServer(args.plans_dir, args.path, args.populations, args.voteshares,
+        workers=args.workers, max_pending=args.max_pending, cache_mb=args.cache_mb, max_age=args.max_age)
+    try:
+        await server.serve(args.host, args.port)
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve district plans and metrics over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--plans-dir', default=DEFAULT_PLANS_DIR, help='directory of plan GeoJSON files and all_plan_metrics')
+    parser.add_argument('--path', default=DEFAULT_PATH_FNAME, help='flip path the plans were exported from')
+    parser.add_argument('--populations', default=DEFAULT_POP_FNAME)
+    parser.add_argument('--voteshares', default=DEFAULT_VOTESHARES_FNAME)
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--max-pending', type=int, default=64, help='maximum number of queued worker jobs')
+    parser.add_argument('--cache-mb', type=int, default=256, help='size of the response cache')
+    parser.add_argument('--max-age', type=int, default=3600, help='Cache-Control max-age in seconds')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
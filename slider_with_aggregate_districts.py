@@ -4,6 +4,7 @@ import streamlit as st
 import pydeck as pdk
 import altair as alt
 import metrics
+import ensemble_stats
 
 st.title('Possible Wisconsin Districting Plans')
 
@@ -45,32 +46,31 @@ metric_descriptions = [ 'SL Index: ' + str(round(current_gdf.loc[1]['SL_index'],
 
 st.sidebar.text('')
 
-# This section encodes the metric graphs
+# This section encodes the metric graphs, 
+# rendered from streaming ensemble summaries rather than raw rows
 metric_gdf_column_names = ['SL_index', 'efficiency_gap', 'mm_gap']
 y_column_names = ['Sainte-Lague Index', 'Efficiency Gap', 'Mean-Median Gap']
-plot_title_names = ["Sainte-Lague Indices by District Plan", "Efficiency Gaps by District Plan", "Mean-Median Gaps By District Plan"]
-metric_scaling = [(.2839,.28394), (-.277,-.28), (-.04445,-.0457)]
-metrics_df = pd.read_json('geojson/all_plan_metrics')
-current_metric_df = pd.DataFrame(metrics_df.loc[district_slider]).transpose()
+plot_title_names = ["Sainte-Lague Indices of District Plans", "Efficiency Gaps of District Plans", "Mean-Median Gaps of District Plans"]
+
+# Histogram bins span each metric's min and max, so no plan is left out.
+# Metrics of nearby plans differ only in their fourth or fifth significant digit,
+# so the charts use fixed bins over those ranges rather than the quantile sketch.
+@st.cache(allow_output_mutation=True)
+def get_ensemble_aggregator():
+    records = list(ensemble_stats.read_metrics_records('geojson/all_plan_metrics'))
+    aggregator = ensemble_stats.EnsembleAggregator(metric_gdf_column_names,
+        histogram_ranges=ensemble_stats.metric_ranges(records, metric_gdf_column_names))
+    return aggregator.update(records)
+
+aggregator = get_ensemble_aggregator()
 
 for i in range(0, 3):
     st.sidebar.text(metric_descriptions[i])
-    altair_metric_chart = alt.Chart(metrics_df).mark_line().encode(
-        alt.X('plan', title = "Plan Number"),
-        alt.Y(metric_gdf_column_names[i], title = y_column_names[i], scale = alt.Scale(domain = metric_scaling[i]))).properties(
-            title = plot_title_names[i],
-            width = 300,
-            height = 300
-        )
-
-    highlighted_plan_points = alt.Chart(current_metric_df).mark_point(filled=True, size=100).encode(
-        alt.X('plan'),
-        alt.Y(metric_gdf_column_names[i]),
-
-    color=alt.value('yellow')
-    )
-
-    st.sidebar.write(altair_metric_chart + highlighted_plan_points)
+    current_value = current_gdf.loc[1][metric_gdf_column_names[i]]
+    st.sidebar.text('  Percentile rank: {0:.1%}'.format(aggregator.percentile_rank(metric_gdf_column_names[i], current_value)))
+    altair_metric_chart = metrics.make_histogram_plot(aggregator.histogram_df(metric_gdf_column_names[i]),
+        current_value, metric_gdf_column_names[i], y_column_names[i], plot_title_names[i])
+    st.sidebar.write(altair_metric_chart)
 
 st.sidebar.text('Party Votes per District:')
 votes_data_df = current_gdf.drop(columns=['color', 'district', 'population', 'dem_voteshare', 'gop_voteshare',
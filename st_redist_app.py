@@ -3,6 +3,7 @@ import geopandas
 import streamlit as st
 import pydeck as pdk
 import metrics
+import ensemble_stats
 
 st.title('Possible Wisconsin Districting Plans')
 
@@ -48,28 +49,30 @@ if metric_type == ("Metrics for Plan " + str(district_slider)):
     st.sidebar.line_chart(voteshare_data_df, 200, 200)
 elif metric_type == "Overall Metrics":
     # Cached since it takes quite a while to run the first time
-    @st.cache
-    def get_metric_df():
-        return metrics.make_metrics_df()
-
-    # Ranges are somewhat arbitrary 
-    def make_sl_plot(metric_df):
-        return metrics.make_metrics_plot(metric_df[['plan_number', 'sl_index']], "sl_index", 
-        'Sainte-Lague Index', 'Sainte-Lague Indices by District Plan',(.2839,.28394))
+    @st.cache(allow_output_mutation=True)
+    def get_ensemble_aggregator():
+        # Histogram bins span each metric's min and max, so no plan is left out;
+        # nearby plans differ only in the fourth or fifth significant digit,
+        # so the charts use fixed bins over those ranges rather than the quantile sketch
+        records = list(ensemble_stats.read_metrics_records('geojson/all_plan_metrics'))
+        aggregator = ensemble_stats.EnsembleAggregator(histogram_ranges=ensemble_stats.metric_ranges(records))
+        return aggregator.update(records)
+
+    def make_sl_plot(aggregator, value):
+        return metrics.make_histogram_plot(aggregator.histogram_df('SL_index'), value, 'SL_index',
+        'Sainte-Lague Index', 'Sainte-Lague Indices of District Plans')
 
     
-    def make_mm_gap_plot(metric_df):
-        return metrics.make_metrics_plot(metric_df[['plan_number', 'mm_gap']], 'mm_gap',
-        'Mean-Median Gap', 'Mean-Median Gaps by District Plan',(-.0446,-.0456))
+    def make_mm_gap_plot(aggregator, value):
+        return metrics.make_histogram_plot(aggregator.histogram_df('mm_gap'), value, 'mm_gap',
+        'Mean-Median Gap', 'Mean-Median Gaps of District Plans')
 
    
-    def make_efficiency_gap_plot(metric_df):
-        return metrics.make_metrics_plot(metric_df[['plan_number', 'efficiency_gap']],
-        'efficiency_gap', 'Efficiency Gap', 'Eficiency Gaps by District Plan',(-.2778,-.28))
-
-    metric_df = get_metric_df()
-    st.sidebar.altair_chart(make_efficiency_gap_plot(metric_df))
-    st.sidebar.altair_chart(make_mm_gap_plot(metric_df))
-    st.sidebar.altair_chart(make_sl_plot(metric_df))
-
-
+    def make_efficiency_gap_plot(aggregator, value):
+        return metrics.make_histogram_plot(aggregator.histogram_df('efficiency_gap'), value, 'efficiency_gap',
+        'Efficiency Gap', 'Efficiency Gaps of District Plans')
+
+    aggregator = get_ensemble_aggregator()
+    st.sidebar.altair_chart(make_efficiency_gap_plot(aggregator, current_gdf.loc[1]['efficiency_gap']))
+    st.sidebar.altair_chart(make_mm_gap_plot(aggregator, current_gdf.loc[1]['mm_gap']))
+    st.sidebar.altair_chart(make_sl_plot(aggregator, current_gdf.loc[1]['SL_index']))